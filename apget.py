@@ -11,7 +11,12 @@ import os.path
 from datetime import datetime
 import dateutil.parser
 import pprint
-import artportalen
+from app.observations.sources.artportalen import client as artportalen
+from app.observations.sources.artportalen import planner
+from app.observations.sources.artportalen import cache
+from app.observations.sources.artportalen import sync
+from app.settings import get_settings
+from app.utils.ratelimit import RateLimiter
 
 # Constants
 DEFAULT_CONF_FILE_PATH = 'adb-get.conf'
@@ -356,7 +361,17 @@ def get_all_observations(oapi, sapi, args):
     taxon_ids = [AVES_TAXON_ID]
     fd = datetime.fromisoformat(args.from_date)
     td = datetime.fromisoformat(args.to_date)
-    obtir = artportalen.ObservationsByTimeIntervalRequester(oapi, p, fd, td, taxon_ids)
+    dplanner = planner.DownloadPlanner(oapi, p, taxon_ids,
+                                       max_workers=args.workers,
+                                       max_count_calls=args.max_count_calls)
+    if args.plan_file and os.path.exists(args.plan_file):
+        plan = dplanner.refreshed(planner.DownloadPlan.load(args.plan_file), fd, td)
+    else:
+        plan = dplanner.plan(fd, td)
+    if args.plan_file:
+        plan.save(args.plan_file)
+    obtir = artportalen.ObservationsByTimeIntervalRequester.from_plan(oapi, p, plan,
+                                                                      max_workers=args.workers)
     if args.print_csv_data_file:
         csv_print_header()
     i = 1
@@ -368,6 +383,23 @@ def get_all_observations(oapi, sapi, args):
         i += 1
 
 
+def sync_cache(oapi, args):
+    """Synchronize the cache database of the area args.area_name with the observations that have
+       been modified since the last sync. The first sync downloads all observations."""
+    p = polygon(args.polygon_file)
+    if not p:
+        sys.exit(5)
+    # The sync updates a new generation of the cache database, which the web app switches to
+    # when it is published
+    with cache.snapshot(get_settings(), args.area_name) as cachedb:
+        dsync = sync.DeltaSync(oapi, cachedb, p, [AVES_TAXON_ID], max_workers=args.workers)
+        result = dsync.run()
+    print(f"Synchronized {result.no_of_observations} observations modified since "
+          f"{result.m_from_date or 'ever'} in {result.seconds} seconds "
+          f"({result.records_per_second} records/s, of which inserting into the cache database "
+          f"{result.ingest_records_per_second} records/s).")
+
+
 def today_RFC3339():
     """Today as an RFC 3339 / ISO 8601 date and time string, in minute resolution."""
     today = datetime.now()
@@ -420,6 +452,23 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
                         help="Get observations [False]")
     parser.add_argument('--get-all-observations', action='store_true', default=False,
                         help="Get all observations [False]")
+    parser.add_argument('--sync-cache', action='store_true', default=False,
+                        help="Synchronize the cache database with the observations modified\
+                              since the last sync [False]")
+    parser.add_argument('--area-name', default="SthlmBetong",
+                        help="Name of the area of the cache database. Use with --sync-cache\
+                              [SthlmBetong]")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of pages to get concurrently. Use with --get-all-observations\
+                              [1]")
+    parser.add_argument('--max-count-calls', type=int, default=1000,
+                        help="Maximum number of count requests when planning the download. Use\
+                              with --get-all-observations [1000]")
+    parser.add_argument('--plan-file',
+                        help="JSON-file where the download plan is saved, and reused from on the\
+                              next run. Use with --get-all-observations")
+    parser.add_argument('--rate-limit', type=float, default=5.0,
+                        help="Maximum number of requests per second to the API:s [5.0]")
     parser.add_argument('-s', '--show-search-filter', action='store_true', default=False,
                         help="Show the search filter used [False]. Use with '-g'")
     parser.add_argument('-r', '--sort-reverse', action='store_true', default=False,
@@ -444,8 +493,13 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
     if not observations_api_key():
         print("Error: Environment variable ARTPORTALEN_OBSERVATIONS_API_KEY not set.")
         sys.exit(1)
-    sapi = artportalen.SpeciesAPI(species_api_key())
-    oapi = artportalen.ObservationsAPI(observations_api_key())
+    # Make sure the connection pool has room for one connection per worker
+    rate_limiter = RateLimiter(rate=args.rate_limit, burst=max(int(args.rate_limit), 1))
+    session = artportalen.ApiSession(artportalen.HTTPSessionConfig(
+        pool_maxsize=max(args.workers, artportalen.HTTPSessionConfig.pool_maxsize)),
+        rate_limiter=rate_limiter)
+    sapi = artportalen.SpeciesAPI(species_api_key(), session=session)
+    oapi = artportalen.ObservationsAPI(observations_api_key(), session=session)
     if args.get_api_versions:
         v = oapi.version(args.verbose)
         print("Observations API:")
@@ -490,9 +544,10 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
                 [pretty_print_taxon(t) for t in taxon_data]
             else:
                 pprint.pprint(taxon_data)
-    if args.polygon_file and not (args.get_observations or args.get_all_observations):
+    if args.polygon_file and not (args.get_observations or args.get_all_observations
+                                  or args.sync_cache):
         print(("Error: --polygon-file flag can only be used with "
-               "-g or --get-all-observations flag."))
+               "-g, --get-all-observations or --sync-cache flag."))
         sys.exit(6)
     if args.get_observations:
         result = get_observations(oapi, sapi, args)
@@ -507,6 +562,9 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
     if args.get_all_observations:
         get_all_observations(oapi, sapi, args)
         sys.exit(0)
+    if args.sync_cache:
+        sync_cache(oapi, args)
+        sys.exit(0)
 
 
 if __name__ == '__main__':
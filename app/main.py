@@ -4,49 +4,96 @@
 
 # FastAPI modules
 from fastapi import FastAPI, status, Request, Query, HTTPException
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import (
+    HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse)
 from fastapi.templating import Jinja2Templates
 
 # Standard Python modules
 from contextlib import asynccontextmanager
 from pathlib import Path
+from types import MappingProxyType
+from typing import Iterator
 import locale
 import logging
 import logging.config
 import time
 import csv
+import hashlib
+from urllib.parse import urlencode
 from datetime import date as dt, timedelta
 from datetime import datetime as dtime
+import jinja2
 
 # Application modules
 from .observations.sources.artportalen.provider import ArtportalenService
+from .observations.sources.artportalen.cache import CacheOpenMode, SpeciesSortKey
 from .observations import model
 from app.mapping.service import MappingService
+from app.utils.assets import FingerprintedStaticFiles
 from app.utils.logging import setup_logging
-from app.utils.changelog_renderer import mistune_markdown_instance
+from app.utils.markdown_cache import MarkdownCache
+from app.utils import timing
+from app.utils.ttlcache import TTLCache
 from .settings import get_settings, release_tag, build_datetime_tag, git_hash_tag
 
 APP_LOGGER_NAME = "microbirding"
 logger = logging.getLogger(APP_LOGGER_NAME)
 
+CHANGELOG_PATH = Path("./CHANGELOG.md")
+
+# Where the observations section goes in a streamed observations page, and the smallest number of
+# characters sent at a time while it is streamed
+OBSERVATIONS_SECTION_PLACEHOLDER = "<!-- observations-section-placeholder -->"
+STREAM_CHUNK_SIZE = 16 * 1024
+
 
 def _require(value, name: str) -> None:
     if value is None:
         raise RuntimeError(f"Missing required setting: {name}")
 
 
+class TimedTemplate(jinja2.Template):
+    """A Jinja2 template that records the time spent rendering it, with render() or generate(), as
+       the "render" stage of the request."""
+
+    def render(self, *args, **kwargs) -> str:
+        with timing.stage("render"):
+            return super().render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs) -> Iterator[str]:
+        # Only the time spent generating the chunks is recorded, not the time the consumer
+        # spends between them, such as sending them to the client
+        chunks = super().generate(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                tic = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - tic
+                yield chunk
+        finally:
+            timing.record("render", elapsed)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     settings = get_settings()
 
     setup_logging(str(settings.LOGGING_CONFIG_FILE))
     logger.info("Starting Microbirding app")
+    version_info = MappingProxyType({"release": release_tag(),
+                                     "built": build_datetime_tag(),
+                                     "git_hash": git_hash_tag()})
     logger.info(
         "Release: %s, Built: %s, Git hash: %s",
-        release_tag(),
-        build_datetime_tag(),
-        git_hash_tag(),
+        version_info["release"],
+        version_info["built"],
+        version_info["git_hash"],
     )
 
     # Ensure required settings exist
@@ -56,19 +103,37 @@ async def lifespan(app: FastAPI):
     # Create dependencies once
     app.state.settings = settings
     app.state.templates = Jinja2Templates(directory=str(settings.TEMPLATES_DIR))
+    app.state.templates.env.template_class = TimedTemplate
 
     # Make feature toggles globally available in all Jinja2 templates
     app.state.templates.env.globals["features"] = settings.features
     # Make environment setting globally available in all Jinja2 templates
     app.state.templates.env.globals["environment"] = settings.ENVIRONMENT
+    # Make the fingerprinted URLs of the static assets available in all Jinja2 templates
+    app.state.templates.env.globals["asset_url"] = assets.url
 
     # Create the ArtportalenProvider
     area_name = "SthlmBetong"
+    # The web app only reads the cache database. It is updated by synchronizations with apget.py,
+    # which publish new generations of it.
     app.state.artportalen_service = ArtportalenService(settings=app.state.settings,
                                                        area_name=area_name,
-                                                       logger=logger)
+                                                       logger=logger,
+                                                       cache_open_mode=CacheOpenMode.READ_ONLY)
 
     app.state.mapping = MappingService(settings.MICROBIRDING_AREA_DIRECTORY)
+    app.state.fragment_cache = TTLCache(maxsize=settings.FRAGMENT_CACHE_SIZE)
+    # Render the changelog and the about pages ahead of the first requests for them
+    app.state.markdown_cache = MarkdownCache(disabled=True)
+    app.state.markdown_cache.preload(
+        [CHANGELOG_PATH]
+        + [settings.CONTENT_DIRECTORY / f for f in settings.ABOUT_SECTIONS.values()])
+    # The values shown on every page
+    secret = settings.UMAMI_WEBSITE_ID
+    app.state.page_context = MappingProxyType({
+        "version_info": version_info,
+        "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
+        "umami_website_id": secret.get_secret_value() if secret else None})
     locale.setlocale(locale.LC_TIME, "sv_SE.UTF-8")
 
     logger.info("Application initialized.")
@@ -76,6 +141,9 @@ async def lifespan(app: FastAPI):
 
     yield
     logger.info("Stopping Microbirding app")
+    logger.info(f"Artportalen HTTP session: {app.state.artportalen_service.http_stats()}")
+    logger.info(f"Artportalen rate limiter: {app.state.artportalen_service.rate_limiter_stats()}")
+    await app.state.artportalen_service.aclose()
 
 
 # We need to get settings here too, to know how to initalize FastAPI
@@ -92,25 +160,102 @@ else:
                   lifespan=lifespan)
 
 ASSETS_DIR = Path(__file__).resolve().parent / "assets"
-app.mount("/app/assets", StaticFiles(directory=str(ASSETS_DIR)), name="assets")
-
-
-def observations_for_presentation(area_name: str, observations_date):
+assets = FingerprintedStaticFiles(directory=ASSETS_DIR, url_prefix="/app/assets")
+app.mount("/app/assets", assets, name="assets")
+
+
+@app.middleware("http")
+async def refresh_cache_database(request: Request, call_next):
+    """Switch to the latest generation of the cache database between requests, so that a
+       request is served from one generation. Rendered sections of dates with changed
+       observations are dropped from the fragment cache, as are all sections if the rarity index
+       changed, and the cache database timestamp shown on every page is updated."""
+    changed = app.state.artportalen_service.refresh_cache()
+    if changed is not None:
+        app.state.page_context = MappingProxyType(
+            app.state.page_context
+            | {"cache_timestamp": app.state.artportalen_service.cache_timestamp()})
+        version = app.state.artportalen_service.rarity_index_version
+        app.state.fragment_cache.invalidate_if(
+            lambda key: (key[2] != version
+                         or any(f <= dt.fromisoformat(key[1]) <= t for f, t in changed)))
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def time_request_stages(request: Request, call_next):
+    """Time the stages of serving the request, see app.utils.timing."""
+    timing.begin_request()
+    with timing.stage("request"):
+        return await call_next(request)
+
+
+# Compress the responses that aren't compressed already, such as HTML pages and fragments. It is
+# added last, so that it is the outermost middleware.
+app.add_middleware(GZipMiddleware,
+                   minimum_size=settings.GZIP_MINIMUM_SIZE,
+                   compresslevel=settings.GZIP_COMPRESS_LEVEL)
+
+
+def server_timing(ns: int, upstream: bool = False) -> str:
+    """The Server-timing header for a request served in `ns` nanoseconds, with the time spent in
+       each stage of serving it and, if `upstream` is true, the metrics in
+       `upstream_http_timing()`."""
+    metrics = [f"API;dur={ns/1000000}", *timing.server_timing_metrics()]
+    if upstream:
+        metrics.append(upstream_http_timing())
+    return ", ".join(metrics)
+
+
+def page_context(request: Request, **values) -> dict:
+    """The data for a Jinja2 page template: the `request`, the values shown on every page (build
+       metadata, when the cache database was last updated and the Umami website id) and the
+       page's own `values`. The values shown on every page are read at startup, and the cache
+       database timestamp again when the app switches to a new generation of it."""
+    return {"request": request, **app.state.page_context, **values}
+
+
+def upstream_http_timing() -> str:
+    """Server-timing metrics with the connection counters of the HTTP session to the Artportalen
+       API:s, the number of searches that shared an identical search in flight, the total time
+       spent waiting for the rate limiter versus in requests, the counters of the observations
+       cache and the fragment cache, the prefetches of adjacent dates, and the time spent
+       waiting for cursors of the cache database, so they can be seen in the browser's dev
+       tools."""
+    stats = app.state.artportalen_service.http_stats()
+    limiter = app.state.artportalen_service.rate_limiter_stats()
+    coalescing = app.state.artportalen_service.coalescing_stats()
+    cache = app.state.artportalen_service.observations_cache_stats()
+    pool = app.state.artportalen_service.cache_pool_stats()
+    fragments = app.state.fragment_cache.stats()
+    prefetch = app.state.artportalen_service.prefetch_stats()
+    return (f'upstream;desc="requests={stats["requests"]} handshakes={stats["handshakes"]} '
+            f'reused={stats["reused_connections"]} coalesced={coalescing["shared"]}", '
+            f'ratelimit;desc="wait={limiter["wait_seconds"]}s '
+            f'requests={limiter["request_seconds"]}s pauses={limiter["pauses"]}", '
+            f'obscache;desc="hits={cache["hits"]} stale={cache["stale_hits"]} '
+            f'misses={cache["misses"]} evictions={cache["evictions"]}", '
+            f'cachedb;desc="checkouts={pool["checkouts"]} waits={pool["waits"]} '
+            f'wait={pool["wait_seconds"]}s cursors={pool["size"]}", '
+            f'fragcache;desc="hits={fragments["hits"]} misses={fragments["misses"]} '
+            f'size={fragments["size"]}", '
+            f'prefetch;desc="started={prefetch["started"]} skipped={prefetch["skipped"]} '
+            f'in_flight={prefetch["in_flight"]}"')
+
+
+async def observations_for_presentation(area_name: str, observations_date):
     """Dictionary with observations for the given `observations_date` (in "YYYY--MM-DD" format) and
        all attribute values needed for the Jinja2 template file
        "hx-observations-list.html" to render HTML.
        THIS SHOULD LIVE IN ./app/observations/model.py"""
-    previous_date = (observations_date - timedelta(days=1)).isoformat()
-    next_date = (observations_date + timedelta(days=1)).isoformat()
-
-    # Get obeservations from the Artportalen API
+    # Get obeservations from the Artportalen API, without blocking a worker thread while waiting
     ap_provider = app.state.artportalen_service
-    observations = ap_provider.get_observations(app.state.mapping,
-                                                area_name,
-                                                observations_date.isoformat(),
-                                                observations_date.isoformat(),
-                                                None,
-                                                None)
+    observations = await ap_provider.get_observations_async(app.state.mapping,
+                                                            area_name,
+                                                            observations_date.isoformat(),
+                                                            observations_date.isoformat(),
+                                                            None,
+                                                            None)
     if not observations:
         extra = {"info": "Failed to get data on observations for a given date",
                  "date": f"{observations_date.isoformat()}"}
@@ -119,7 +264,18 @@ def observations_for_presentation(area_name: str, observations_date):
         observations = ["Failed"]
     else:
         # Transform the observations to representations suitable for Jinja2
-        observations = model.transformed_observations(observations)
+        with timing.stage("transform"):
+            observations = model.transformed_observations(observations,
+                                                          ap_provider.rarity_index)
+    return observations_presentation(observations_date, observations)
+
+
+def observations_presentation(observations_date, observations: list) -> dict:
+    """Dictionary with the `observations` (as transformed by model.transformed_observations(), or
+       ["Failed"]) for `observations_date` and the other attribute values needed for the Jinja2
+       template file "hx-observations-list.html"."""
+    previous_date = (observations_date - timedelta(days=1)).isoformat()
+    next_date = (observations_date + timedelta(days=1)).isoformat()
     return {"day": observations_date.strftime('%A, %-d/%-m').capitalize(),
             "is_today": observations_date == dt.today(),
             "year": observations_date.year,
@@ -129,6 +285,113 @@ def observations_for_presentation(area_name: str, observations_date):
             "observations": observations}
 
 
+async def observations_section(area_name: str, observations_date) -> tuple[str, str]:
+    """The rendered Jinja2 template file "hx-observations-list.html" with the observations for
+       the given `observations_date`, and its strong ETag. The sections of past dates are kept in
+       the fragment cache as long as their observations are kept in the observations cache, or
+       until a sync changes the observations of the date."""
+    key = fragment_key(area_name, observations_date.isoformat())
+    with timing.stage("cache"):
+        cached = app.state.fragment_cache.get(key)
+    if cached is not None and not cached.stale:
+        return cached.value
+    obs = await observations_for_presentation(area_name, observations_date)
+    template = app.state.templates.get_template("./observations/hx-observations-list.html")
+    html = template.render(obs)
+    return html, cache_observations_section(key, obs, html)
+
+
+def cache_observations_section(key: tuple, obs: dict, html: str) -> str:
+    """Keep the rendered observations section `html` with the observations `obs` (from
+       `observations_for_presentation()`) in the fragment cache under `key`, if it is of a past
+       date and the observations could be fetched. Returns the ETag of the section."""
+    etag = f'"{hashlib.sha256(html.encode("utf-8")).hexdigest()[:32]}"'
+    if not obs["is_today"] and obs["observations"] != ["Failed"]:
+        ttl = app.state.artportalen_service.observations_ttl(obs["date"])
+        app.state.fragment_cache.set(key, (html, etag), ttl)
+    return etag
+
+
+def fragment_key(area_name: str, date_iso: str) -> tuple[str, str, int]:
+    """The key in the fragment cache of the observations section of `date_iso`. It has the
+       version of the rarity index the section is highlighted with, so that sections rendered
+       with an older rarity index aren't served, or their ETags. The key is to be taken before
+       the observations are fetched, so that a section is never kept under a newer version than
+       it was rendered with."""
+    return area_name, date_iso, app.state.artportalen_service.rarity_index_version
+
+
+async def streamed_observations_page(index_page: str,
+                                     jinja2_data: dict,
+                                     area_name: str,
+                                     observations_date):
+    """The page template `index_page` with the observations section for `observations_date`, in
+       chunks of HTML. The part of the page before the section is sent before the observations are
+       fetched, and the section is sent while Jinja2 generates it. The section is kept in the
+       fragment cache like in `observations_section()`. Since the response has been started, an
+       error while fetching or rendering the observations can't become an error response; the
+       section shows that getting the observations failed instead, and the rest of the page is
+       sent."""
+    page = app.state.templates.get_template(index_page).render(
+        jinja2_data | {"observations_section": OBSERVATIONS_SECTION_PLACEHOLDER})
+    head, placeholder, tail = page.partition(OBSERVATIONS_SECTION_PLACEHOLDER)
+    yield head
+    if not placeholder:
+        # The page template doesn't show the observations section
+        return
+
+    key = fragment_key(area_name, observations_date.isoformat())
+    template = app.state.templates.get_template("./observations/hx-observations-list.html")
+    section = []
+    pending = []
+    pending_size = 0
+    try:
+        obs = await observations_for_presentation(area_name, observations_date)
+        prefetch_adjacent_dates(area_name, observations_date)
+        for chunk in template.generate(obs):
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= STREAM_CHUNK_SIZE:
+                section.extend(pending)
+                yield "".join(pending)
+                pending = []
+                pending_size = 0
+    except Exception as e:
+        logger.warning("Failed to stream the observations section",
+                       exc_info=True,
+                       extra={"exception": e, "date": observations_date.isoformat()})
+        if section:
+            # Part of the section has been sent already, so it can only be ended
+            yield tail
+        else:
+            yield template.render(observations_presentation(observations_date, ["Failed"])) + tail
+        return
+    section.extend(pending)
+    yield "".join(pending) + tail
+    cache_observations_section(key, obs, "".join(section))
+
+
+def prefetch_adjacent_dates(area_name: str, observations_date):
+    """Start fetching the observations of the days before and after `observations_date` into the
+       observations cache, since the user is likely to navigate to one of them next. The day
+       after is left out if it is in the future."""
+    dates = [observations_date - timedelta(days=1)]
+    if observations_date + timedelta(days=1) <= dt.today():
+        dates.append(observations_date + timedelta(days=1))
+    app.state.artportalen_service.prefetch_observations(app.state.mapping,
+                                                        area_name,
+                                                        [d.isoformat() for d in dates])
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """True if the client already has the representation with `etag`, according to the
+       If-None-Match header of the `request`."""
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+
+
 def dummy_species_data():
     """Dummy species data."""
 #    {"name": "Skrattmås",
@@ -148,42 +411,88 @@ def dummy_species_data():
               encoding="utf-8") as f:
         reader = csv.DictReader(f, delimiter=";")
         for row in reader:
-            # Convert numeric fields if needed
             row["name"] = row["taxon.vernacularName"]
-            obs = int(row["observations"])
-            # Change rarity category to Swedish
-            row["rarity_classification"] = SWEDISH_RARITY_CATEGORIES[row["rarity_classification"]]
-            # Put spaces between every group of three digits
-            row["observations"] = f"{obs:,}".replace(",", " ")
-            d = format_mm_dd_swedish(row["earliest_date_any_year"])
-            row["earliest_date_any_year"] = d
-            d = format_mm_dd_swedish(row["median_earliest_date_per_year"])
-            row["median_earliest_date_per_year"] = d
-            d = format_mm_dd_swedish(row["avg_earliest_date_per_year"])
-            row["avg_earliest_date_per_year"] = d
-            d = format_mm_dd_swedish(row["latest_date_any_year"])
-            row["latest_date_any_year"] = d
-            d = format_mm_dd_swedish(row["median_latest_date_per_year"])
-            row["median_latest_date_per_year"] = d
-            d = format_mm_dd_swedish(row["avg_latest_date_per_year"])
-            row["avg_latest_date_per_year"] = d
-            species.append(row)
+            species.append(presentable_species(row))
     return species
 
 
-def species_for_presentation(area_name: str):
-    """List of species and their observation data."""
-    return dummy_species_data()
-    # Get species data from the Artportalen API
-    ap_provider = app.state.artportalen_provider
-    species = ap_provider.get_species(app.state.mapping, area_name)
-    return species
+def presentable_species(row: dict) -> dict:
+    """The species summary `row` with the values formatted for the template file
+       "page-species.html"."""
+    # Convert numeric fields if needed
+    obs = int(row["observations"])
+    # Change rarity category to Swedish
+    row["rarity_classification"] = SWEDISH_RARITY_CATEGORIES[row["rarity_classification"]]
+    # Put spaces between every group of three digits
+    row["observations"] = f"{obs:,}".replace(",", " ")
+    for k in ["earliest_date_any_year", "median_earliest_date_per_year",
+              "avg_earliest_date_per_year", "latest_date_any_year",
+              "median_latest_date_per_year", "avg_latest_date_per_year"]:
+        row[k] = format_mm_dd_swedish(row[k])
+    return row
+
+
+def species_for_presentation(area_name: str,
+                             sort_key: SpeciesSortKey,
+                             descending: bool,
+                             name_prefix: str,
+                             page: int):
+    """Dictionary with a page of species and their observation data, sorted on `sort_key` and
+       optionally only those whose names start with `name_prefix`, and all attribute values
+       needed for the Jinja2 template file "hx-species-list.html" to render HTML. The species
+       come from the species summary in the cache database if it is enabled, otherwise from test
+       data on one page."""
+    page_size = app.state.settings.SPECIES_PAGE_SIZE
+    if app.state.settings.features.cache_database_enabled:
+        ap_provider = app.state.artportalen_service
+        result = ap_provider.species_summary_page(sort_key,
+                                                  descending,
+                                                  name_prefix,
+                                                  skip=(page - 1) * page_size,
+                                                  take=page_size)
+        species = []
+        for row in result["records"]:
+            row["name"] = row["taxon_vernacularName"]
+            row["earliest_date"] = row["earliest_date"].isoformat()
+            row["latest_date"] = row["latest_date"].isoformat()
+            species.append(presentable_species(row))
+        total_count = result["totalCount"]
+    else:
+        species = [s for s in dummy_species_data() if s["category"] == "Total"]
+        total_count = len(species)
+        page = 1
+        page_size = total_count
+    if not total_count and not name_prefix:
+        species = ["Failed"]
+    params = {"sort": sort_key.value,
+              "order": "desc" if descending else "asc",
+              "q": name_prefix or ""}
+    return {"species": species,
+            "sort": params["sort"],
+            "order": params["order"],
+            "q": params["q"],
+            "page": page,
+            "total_count": total_count,
+            "query": urlencode(params | {"page": page}),
+            "previous_query": urlencode(params | {"page": page - 1}) if page > 1 else None,
+            "next_query": (urlencode(params | {"page": page + 1})
+                           if page * page_size < total_count else None)}
+
+
+def species_query_parameters(sort: str, order: str, q: str, page: int):
+    """The sort key, sort order, name prefix and page number of the species list from the query
+       parameters of a request, with defaults for invalid values."""
+    try:
+        sort_key = SpeciesSortKey(sort)
+    except ValueError:
+        sort_key = SpeciesSortKey.OBSERVATIONS
+    return sort_key, order != "asc", (q or "").strip() or None, max(page, 1)
 
 
 # The application resources
 
 @app.get("/", response_class=HTMLResponse)
-def get_index_file(request: Request, date: str = Query(None), index_page: str = Query(None)):
+async def get_index_file(request: Request, date: str = Query(None), index_page: str = Query(None)):
     """The main application page (page-observations.html) with observations for the given `date`.
         The `index_page` query parameter is a development for easily chosing which Jinja2 template
        to use as the index_page."""
@@ -213,27 +522,38 @@ def get_index_file(request: Request, date: str = Query(None), index_page: str =
         observations_date = dt.today()
 
     area_name = "SthlmBetong"
-    obs = observations_for_presentation(area_name, observations_date)
-    secret = app.state.settings.UMAMI_WEBSITE_ID
-    umami_id = secret.get_secret_value() if secret else None
-    jinja2_data = {"request": request,
-                   "day": obs["day"],
-                   "year": observations_date.year,
-                   "is_today": obs["is_today"],
-                   "previous_date": obs["previous_date"],
-                   "date": obs["date"],
-                   "next_date": obs["next_date"],
-                   "observations": obs["observations"],
-                   "version_info": {"release": release_tag(),
-                                    "built": build_datetime_tag(),
-                                    "git_hash": git_hash_tag()},
-                   "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                   "umami_website_id": umami_id}
-    result = app.state.templates.TemplateResponse(index_page, jinja2_data)
+    section_key = fragment_key(area_name, observations_date.isoformat())
+    if (app.state.settings.OBSERVATIONS_PAGE_STREAMING
+            and not app.state.fragment_cache.has_fresh(section_key)):
+        # The page can't have an ETag, since it is sent before it is rendered
+        result = StreamingResponse(streamed_observations_page(index_page,
+                                                              page_context(request),
+                                                              area_name,
+                                                              observations_date),
+                                   media_type="text/html",
+                                   headers={"Cache-Control": "no-cache"})
+        toc = time.perf_counter_ns()
+        # Set Server-timing header (server excution time in ms until the response starts)
+        result.headers["Server-timing"] = server_timing(toc - tic)
+        return result
+
+    section, section_etag = await observations_section(area_name, observations_date)
+    prefetch_adjacent_dates(area_name, observations_date)
+    jinja2_data = page_context(request, observations_section=section)
+    # The page is the observations section and the page template with the values above
+    page_key = repr([section_etag, index_page, dict(jinja2_data["version_info"]),
+                     jinja2_data["cache_timestamp"], jinja2_data["umami_website_id"]])
+    etag = f'"{hashlib.sha256(page_key.encode("utf-8")).hexdigest()[:32]}"'
+    if not_modified(request, etag):
+        result = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    else:
+        result = app.state.templates.TemplateResponse(index_page, jinja2_data)
+    result.headers["ETag"] = etag
+    result.headers["Cache-Control"] = "no-cache"
 
     toc = time.perf_counter_ns()
     # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-    result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+    result.headers["Server-timing"] = server_timing(toc - tic, upstream=True)
     return result
 
 
@@ -243,24 +563,13 @@ def get_changelog(request: Request):
        of the app."""
     tic = time.perf_counter_ns()
 
-    markdown = mistune_markdown_instance(disabled=True)
-
-    with open("./CHANGELOG.md") as f:
-        html = markdown(f.read())
-    secret = app.state.settings.UMAMI_WEBSITE_ID
-    umami_id = secret.get_secret_value() if secret else None
-    jinja2_data = {"request": request,
-                   "changelog_html": html,
-                   "version_info": {"release": release_tag(),
-                                    "built": build_datetime_tag(),
-                                    "git_hash": git_hash_tag()},
-                   "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                   "umami_website_id": umami_id}
+    html = app.state.markdown_cache.html(CHANGELOG_PATH)
+    jinja2_data = page_context(request, changelog_html=html)
     result = app.state.templates.TemplateResponse("./about/page-changelog.html", jinja2_data)
 
     toc = time.perf_counter_ns()
     # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-    result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+    result.headers["Server-timing"] = server_timing(toc - tic)
     return result
 
 
@@ -269,19 +578,12 @@ def get_maps(request: Request):
     """The maps page (page-maps.html) displaying the map of SthlmBetong."""
     tic = time.perf_counter_ns()
 
-    secret = app.state.settings.UMAMI_WEBSITE_ID
-    umami_id = secret.get_secret_value() if secret else None
-    jinja2_data = {"request": request,
-                   "version_info": {"release": release_tag(),
-                                    "built": build_datetime_tag(),
-                                    "git_hash": git_hash_tag()},
-                   "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                   "umami_website_id": umami_id}
+    jinja2_data = page_context(request)
     result = app.state.templates.TemplateResponse("./maps/page-maps.html", jinja2_data)
 
     toc = time.perf_counter_ns()
     # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-    result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+    result.headers["Server-timing"] = server_timing(toc - tic)
     return result
 
 
@@ -304,28 +606,53 @@ def format_mm_dd_swedish(mm_dd: str) -> str:
 if settings.features.species_page_enabled:
 
     @app.get("/species", response_class=HTMLResponse)
-    def get_species(request: Request):
-        """The species page (page-species.html) displaying info on all species that have been
-           observed in the area."""
+    def get_species(request: Request,
+                    sort: str = Query(SpeciesSortKey.OBSERVATIONS.value),
+                    order: str = Query("desc"),
+                    q: str = Query(None),
+                    page: int = Query(1)):
+        """The species page (page-species.html) displaying info on the species that have been
+           observed in the area, a page at a time, sorted on `sort` in `order` ("asc" or
+           "desc"), and optionally only the species whose names start with `q`."""
         tic = time.perf_counter_ns()
 
         area_name = "SthlmBetong"
-        species = species_for_presentation(area_name)
-
-        secret = app.state.settings.UMAMI_WEBSITE_ID
-        umami_id = secret.get_secret_value() if secret else None
-        jinja2_data = {"request": request,
-                       "species": species,
-                       "version_info": {"release": release_tag(),
-                                        "built": build_datetime_tag(),
-                                        "git_hash": git_hash_tag()},
-                       "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                       "umami_website_id": umami_id}
+        species = species_for_presentation(area_name,
+                                           *species_query_parameters(sort, order, q, page))
+
+        jinja2_data = page_context(request, **species)
         result = app.state.templates.TemplateResponse("./species/page-species.html", jinja2_data)
 
         toc = time.perf_counter_ns()
         # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        result.headers["Server-timing"] = server_timing(toc - tic)
+        return result
+
+    @app.get("/hx/species-section", response_class=HTMLResponse)
+    def hx_species_section(request: Request,
+                           sort: str = Query(SpeciesSortKey.OBSERVATIONS.value),
+                           order: str = Query("desc"),
+                           q: str = Query(None),
+                           page: int = Query(1)):
+        """The species HTML <section> element with a page of species, see get_species()."""
+        # We only return this resource if it was triggered by an HTMX control
+        if request.headers.get("HX-Request") != "true":
+            raise HTTPException(404)
+        tic = time.perf_counter_ns()
+
+        area_name = "SthlmBetong"
+        species = species_for_presentation(area_name,
+                                           *species_query_parameters(sort, order, q, page))
+        jinja2_data = {"request": request, **species}
+        result = app.state.templates.TemplateResponse("./species/hx-species-list.html",
+                                                      jinja2_data)
+
+        toc = time.perf_counter_ns()
+        # Let the browser's address bar show the species page with the same sorting, filtering
+        # and page
+        result.headers["HX-Push-Url"] = f"/species?{species['query']}"
+        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
+        result.headers["Server-timing"] = server_timing(toc - tic)
         return result
 
 
@@ -346,27 +673,20 @@ def get_about(request: Request, slug: str):
     if slug not in app.state.settings.ABOUT_SECTIONS:
         raise HTTPException(status_code=404, detail="Unknown section")
 
-    markdown = mistune_markdown_instance(disabled=True)
     md_path = app.state.settings.CONTENT_DIRECTORY / app.state.settings.ABOUT_SECTIONS[slug]
-    if not md_path.exists():
+    try:
+        html = app.state.markdown_cache.html(md_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=500, detail="Missing content file")
-    html = markdown(md_path.read_text(encoding="utf-8"))
-
-    secret = app.state.settings.UMAMI_WEBSITE_ID
-    umami_id = secret.get_secret_value() if secret else None
-    jinja2_data = {"request": request,
-                   "active_slug": slug,
-                   "section_html": html,
-                   "version_info": {"release": release_tag(),
-                                    "built": build_datetime_tag(),
-                                    "git_hash": git_hash_tag()},
-                   "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                   "umami_website_id": umami_id}
+
+    jinja2_data = page_context(request,
+                               active_slug=slug,
+                               section_html=html)
     result = app.state.templates.TemplateResponse("./about/page-about.html", jinja2_data)
 
     toc = time.perf_counter_ns()
     # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-    result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+    result.headers["Server-timing"] = server_timing(toc - tic)
     return result
 
 
@@ -374,30 +694,28 @@ def get_about(request: Request, slug: str):
 # All of these resources have the prefix "/hx/" in their URL path.
 
 @app.get("/hx/observations-section", response_class=HTMLResponse)
-def hx_observations_section(request: Request, date: str = Query(None)):
+async def hx_observations_section(request: Request, date: str = Query(None)):
     """The observations HTML <section> element with the observations for the given `date`."""
     # We only return this resource if it was triggered by an HTMX control. HTTP requests generated
     # by HTMX set the HTTP header "HX-request: true", so we can check for that.
     if request.headers.get("HX-Request") != "true":
         raise HTTPException(404)
+    tic = time.perf_counter_ns()
     # We assume we have a valid date that isn't ahead of today's date.
     observations_date = dt.fromisoformat(date)
     area_name = "SthlmBetong"
-    obs = observations_for_presentation(area_name, observations_date)
-    secret = app.state.settings.UMAMI_WEBSITE_ID
-    umami_id = secret.get_secret_value() if secret else None
-    jinja2_data = {"request": request,
-                   "day": obs["day"],
-                   "year": observations_date.year,
-                   "is_today": obs["is_today"],
-                   "previous_date": obs["previous_date"],
-                   "date": obs["date"],
-                   "next_date": obs["next_date"],
-                   "observations": obs["observations"],
-                   "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                   "umami_website_id": umami_id}
-    return app.state.templates.TemplateResponse("./observations/hx-observations-list.html",
-                                                jinja2_data)
+    section, etag = await observations_section(area_name, observations_date)
+    prefetch_adjacent_dates(area_name, observations_date)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if not_modified(request, etag):
+        result = Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    else:
+        result = HTMLResponse(section, headers=headers)
+
+    toc = time.perf_counter_ns()
+    # Set Server-timing header (server excution time in ms, not including FastAPI itself)
+    result.headers["Server-timing"] = server_timing(toc - tic, upstream=True)
+    return result
 
 
 # MapLibre GL JS resources (experimental)
@@ -425,20 +743,34 @@ def get_map_style():
     return JSONResponse(style, headers={"Cache-Control": "no-cache"})
 
 
+# Metrics resource, for tuning the app with data from production
+
+if settings.features.metrics_endpoint_enabled:
+
+    @app.get("/metrics")
+    def get_metrics():
+        """Histograms of the time spent in each stage of serving requests (see app.utils.timing),
+           and the counters of the HTTP sessions, caches and cursor pool."""
+        service = app.state.artportalen_service
+        metrics = {"stages": timing.histograms(),
+                   "upstream": service.http_stats(),
+                   "coalescing": service.coalescing_stats(),
+                   "rate_limiter": service.rate_limiter_stats(),
+                   "observations_cache": service.observations_cache_stats(),
+                   "fragment_cache": app.state.fragment_cache.stats(),
+                   "markdown_cache": app.state.markdown_cache.stats(),
+                   "assets": assets.stats(),
+                   "cache_pool": service.cache_pool_stats(),
+                   "prefetch": service.prefetch_stats()}
+        return JSONResponse(metrics, headers={"Cache-Control": "no-store"})
+
+
 # The application 404 exception handler
 
 @app.exception_handler(404)
 async def not_found(request: Request, exc):
     """Render a 404 page for missing resources."""
-    secret = app.state.settings.UMAMI_WEBSITE_ID
-    umami_id = secret.get_secret_value() if secret else None
-    jinja2_data = {"request": request,
-                   "path": request.url.path,
-                   "version_info": {"release": release_tag(),
-                                    "built": build_datetime_tag(),
-                                    "git_hash": git_hash_tag()},
-                   "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                   "umami_website_id": umami_id}
+    jinja2_data = page_context(request, path=request.url.path)
     return app.state.templates.TemplateResponse("./page-404.html", jinja2_data, status_code=404)
 
 
@@ -447,7 +779,7 @@ async def not_found(request: Request, exc):
 if settings.ENVIRONMENT == "DEV":
 
     @app.get("/design-system", response_class=HTMLResponse)
-    def get_design_system(request: Request):
+    async def get_design_system(request: Request):
         """The design system page (page-design-system.html) displaying UI stuff used in the app."""
         tic = time.perf_counter_ns()
 
@@ -455,20 +787,12 @@ if settings.ENVIRONMENT == "DEV":
         date = "2025-12-15"
         area_name = "SthlmBetong"
         observations_date = dt.fromisoformat(date)
-        obs = observations_for_presentation(app.state.mapping, area_name, observations_date)
+        obs = await observations_for_presentation(area_name, observations_date)
         obs_no = 5
-        secret = app.state.settings.UMAMI_WEBSITE_ID
-        umami_id = secret.get_secret_value() if secret else None
-        jinja2_data = {"request": request,
-                       "o": obs["observations"][obs_no],
-                       "version_info": {"release": release_tag(),
-                                        "built": build_datetime_tag(),
-                                        "git_hash": git_hash_tag()},
-                       "cache_timestamp": app.state.artportalen_service.cache_timestamp(),
-                       "umami_website_id": umami_id}
+        jinja2_data = page_context(request, o=obs["observations"][obs_no])
         result = app.state.templates.TemplateResponse("./page-design-system.html", jinja2_data)
 
         toc = time.perf_counter_ns()
         # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        result.headers["Server-timing"] = server_timing(toc - tic)
         return result
@@ -2,8 +2,11 @@
 Pydantic models for the mapping module.
 """
 
+from array import array
 from typing import List, Any
-from pydantic import BaseModel, Field, model_serializer, model_validator
+from pydantic import (
+    BaseModel, ConfigDict, Field, PrivateAttr, ValidationError, model_serializer,
+    model_validator)
 
 
 class Coordinate(BaseModel):
@@ -39,30 +42,56 @@ class Coordinate(BaseModel):
 class Geopolygon(BaseModel):
     """Represents a geopolygon with at least 3 coordinates. The coordinates are implicitly
        connected in the order they appear, and the last coordinate is implicitly connected
-       to the first coordinate."""
-    polygon: List[Coordinate] = Field(
-        ...,
-        description="List of coordinates that define a closed polygon."
-    )
+       to the first coordinate. The coordinates are validated as Coordinate:s when the
+       geopolygon is created, but kept as a private contiguous array of float64 values that
+       can't be changed, so that its serialized form can be made once."""
+    model_config = ConfigDict(frozen=True)
 
-    @model_validator(mode="before")
+    _coordinates: array = PrivateAttr()
+    _as_list: tuple[tuple[float, float], ...] = PrivateAttr()
+
+    @model_validator(mode="wrap")
     @classmethod
-    def parse_list(cls, v):
+    def parse_list(cls, v, handler):
+        if isinstance(v, Geopolygon):
+            return v
         # If we get a raw list of coordinate pairs, treat it as the polygon field
         if isinstance(v, list):
-            return {"polygon": v}
-        return v
-
-    @model_validator(mode="after")
-    def check_polygon(self):
-        if len(self.polygon) < 3:
+            v = {"polygon": v}
+        if not isinstance(v, dict) or "polygon" not in v:
+            raise ValueError("A Geopolygon must be a list of coordinates.")
+        coordinates = array("d")
+        for i, c in enumerate(v["polygon"]):
+            try:
+                c = c if isinstance(c, Coordinate) else Coordinate.model_validate(c)
+            except ValidationError as e:
+                raise ValueError(f"Invalid coordinate at index {i}: {e.errors()[0]['msg']}")
+            coordinates.append(c.longitude)
+            coordinates.append(c.latitude)
+        if len(coordinates) < 6:
             raise ValueError("A Geopolygon must contain at least 3 coordinates.")
+
+        self = handler({})
+        self._coordinates = coordinates
+        self._as_list = tuple(zip(coordinates[0::2], coordinates[1::2]))
         return self
 
+    @property
+    def coordinates(self) -> memoryview:
+        """Longitudes and latitudes of the coordinates, interleaved, as a read-only view of the
+           float64 values."""
+        return memoryview(self._coordinates).toreadonly()
+
+    @property
+    def polygon(self) -> list[Coordinate]:
+        """The coordinates as Coordinate:s."""
+        return [Coordinate(longitude=lon, latitude=lat) for lon, lat in self._as_list]
+
     @model_serializer
     def serialize_as_list(self):
-        """Emit as a list of [longitude, latitude] pairs."""
-        return [[c.longitude, c.latitude] for c in self.polygon]
+        """Emit as a list of [longitude, latitude] pairs. The list is made once, and is
+           immutable (a tuple of tuples)."""
+        return self._as_list
 
 
 class BoundingBox(BaseModel):
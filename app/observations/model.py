@@ -4,11 +4,13 @@ Application model of observations independent of sources
 
 from datetime import datetime as dtime
 from .sources.artportalen import client
+from .rarity import RarityIndex, UNUSUAL_CLASSIFICATIONS
 
 
-def transformed_observations(artportalen_observations):
+def transformed_observations(artportalen_observations, rarity_index: RarityIndex = None):
     """List of transformed observations suitable for rendering in HTML with a Jinja2 template.
        Here we can add rarity data and other stuff which affects how observations is presented.
+       The rarity of each observation is looked up in `rarity_index`, if given.
        THIS SHOULD LIVE IN ./app/observations/model.py"""
     result = []
     for o in artportalen_observations["records"]:
@@ -20,8 +22,9 @@ def transformed_observations(artportalen_observations):
         info = {"name": name}
 
         # Fix a compact representation of the time of the observation
-        d = dtime.fromisoformat(o["event"]["startDate"])
-        starttime = d.astimezone().strftime("%H:%M")
+        d = dtime.fromisoformat(o["event"]["startDate"]).astimezone()
+        month = d.month
+        starttime = d.strftime("%H:%M")
         d = dtime.fromisoformat(o["event"]["endDate"])
         endtime = d.astimezone().strftime("%H:%M")
         if starttime == "00:00" and endtime == "23:59":
@@ -178,12 +181,13 @@ def transformed_observations(artportalen_observations):
             # Set URL to observation info at source
             info["data_source_observation_url"] = o["occurrence"]["occurrenceId"]
 
-        # Add the rarity level according to some model not yet decided!
-        # TBD
-#        if info["name"] == "Ringnäbbad mås":
-#            info["rarity"] = 10
-#        else:
-#            info["rarity"] = 1
+        # Add the rarity classification of the species in the month of the observation
+        if rarity_index:
+            rarity = rarity_index.classification(o["taxon"].get("scientificName"), month)
+        else:
+            rarity = None
+        info["rarity"] = rarity
+        info["is_unusual"] = rarity in UNUSUAL_CLASSIFICATIONS
 
         result.append(info)
     return result
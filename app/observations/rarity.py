@@ -0,0 +1,51 @@
+"""
+The rarity index, a lookup of how rare each species is in the area in each month of the year,
+used to highlight unusual observations. It is built from the species summary in the cache
+database.
+"""
+
+from .sources.artportalen.cache import MONTH_NAMES, RARITY_CLASSIFICATIONS
+
+CLASSIFICATIONS = [classification for _, classification in RARITY_CLASSIFICATIONS]
+
+# Observations of species with these classifications in the month of the observation are
+# highlighted
+UNUSUAL_CLASSIFICATIONS = {"Rare", "Very rare"}
+
+
+class RarityIndex:
+    """The monthly rarity classifications of taxa, by scientific name. The classifications of a
+       taxon are kept as a bytes object with the index in CLASSIFICATIONS of the classification
+       for each month, so a lookup is a dictionary lookup and an indexing."""
+
+    def __init__(self, ranks: dict[str, bytes] = None):
+        """Initialization."""
+        self._ranks = ranks or {}
+
+    @classmethod
+    def from_species_summary(cls, rows: list[dict]) -> "RarityIndex":
+        """The rarity index for the species summary `rows` (see DuckDBCache.species_data())."""
+        rank = {classification: i for i, classification in enumerate(CLASSIFICATIONS)}
+        ranks = {}
+        for row in rows:
+            if row["category"] != "Total":
+                continue
+            ranks[row["taxon_scientificName"]] = bytes(
+                rank[row[f"rarity_classification_in_{month}"]] for month in MONTH_NAMES)
+        return cls(ranks)
+
+    def __len__(self) -> int:
+        return len(self._ranks)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, RarityIndex):
+            return NotImplemented
+        return self._ranks == other._ranks
+
+    def classification(self, scientific_name: str, month: int) -> str | None:
+        """The rarity classification of the taxon `scientific_name` in `month` (1-12), or None
+           if the taxon isn't in the index."""
+        ranks = self._ranks.get(scientific_name)
+        if ranks is None:
+            return None
+        return CLASSIFICATIONS[ranks[month - 1]]
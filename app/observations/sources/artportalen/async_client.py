@@ -0,0 +1,282 @@
+"""
+Module for interacting with Artportalens API:s with asyncio. The classes here are the async
+counterparts of SpeciesAPI and ObservationsAPI in the client module, and they use the same
+SearchFilter class and the same retry policy for HTTP status 429 (Too many requests).
+"""
+
+from __future__ import annotations
+import logging
+import time
+import httpx
+from tenacity import (
+    retry, stop_after_attempt,
+    retry_if_exception, before_sleep_log)
+from app.utils import timing
+from app.utils.logging import log_request
+from app.utils.ratelimit import RateLimiter, retry_after_seconds
+from .client import (
+    API_ROOT_URL, API_KEY_HTTP_HEADER, API_OUTPUTFIELDSET_VALUES,
+    HTTPSessionConfig, SearchFilter, auth_headers, wait_retry_after)
+
+logger = logging.getLogger(__name__)
+
+
+def _is_429_http_error(e: Exception):
+    """True if the exception `e` is an HTTPStatusError with status 429."""
+    return (
+        isinstance(e, httpx.HTTPStatusError)
+        and getattr(e, "response", None) is not None
+        and getattr(e.response, "status_code", None) == 429
+    )
+
+
+class AsyncApiSession:
+    """A pooled asyncio HTTP session with keep-alive connections to the Artportalen API:s. It is
+       the async counterpart of client.ApiSession, and is configured with the same
+       HTTPSessionConfig and can share a RateLimiter with it."""
+
+    def __init__(self, config: HTTPSessionConfig = None, rate_limiter: RateLimiter = None):
+        """Initialization."""
+        self.config = config or HTTPSessionConfig()
+        self.rate_limiter = rate_limiter
+        keepalive = self.config.pool_maxsize if self.config.keep_alive else 0
+        limits = httpx.Limits(max_connections=self.config.pool_maxsize,
+                              max_keepalive_connections=keepalive)
+        timeout = httpx.Timeout(self.config.read_timeout, connect=self.config.connect_timeout)
+        self.client = httpx.AsyncClient(limits=limits,
+                                        timeout=timeout,
+                                        headers={"Accept-Encoding": self.config.accept_encoding})
+        self._requests = 0
+        self._handshakes = 0
+
+    async def _trace(self, event_name: str, info: dict):
+        """Trace callback for httpcore, used to count new connections."""
+        if event_name == "connection.connect_tcp.complete":
+            self._handshakes += 1
+
+    async def request(self, method: str, url: str, timeout=None, **kwargs) -> httpx.Response:
+        """Send a HTTP request with the session. `timeout` is a number of seconds and defaults to
+           the timeouts in the session config."""
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        self._requests += 1
+        kwargs["extensions"] = {"trace": self._trace}
+        if not self.rate_limiter:
+            with timing.stage("http"):
+                return await self.client.request(method, url, **kwargs)
+
+        await self.rate_limiter.acquire_async()
+        tic = time.perf_counter()
+        r = await self.client.request(method, url, **kwargs)
+        seconds = time.perf_counter() - tic
+        self.rate_limiter.record_request(seconds)
+        timing.record("http", seconds)
+        if r.status_code == 429:
+            self.rate_limiter.pause(retry_after_seconds(r.headers))
+        return r
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        """Send a HTTP GET request with the session."""
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        """Send a HTTP POST request with the session."""
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict[str, int]:
+        """Counters for the session, with the same keys as client.ApiSession.stats()."""
+        return {"requests": self._requests,
+                "handshakes": self._handshakes,
+                "reused_connections": max(self._requests - self._handshakes, 0)}
+
+    async def aclose(self):
+        """Close all connections in the pool."""
+        await self.client.aclose()
+
+
+class AsyncSpeciesAPI:
+    """Handles async requests to Artportalens Artfakta - Species information API."""
+
+    def __init__(self, api_key: str, session: AsyncApiSession = None):
+        """Initialization. The client is responsible for managing secrets. If no `session` is
+           given the object gets its own pooled session."""
+        self.key = api_key
+        self.session = session or AsyncApiSession()
+        self.url = API_ROOT_URL + "/information/v1/speciesdataservice/v1/"
+        self.search_url = self.url + "speciesdata"
+        self.headers = auth_headers(self.key)
+
+    async def taxa_by_name(self, name, exact_match=True):
+        """Returns list of all taxa that match the name."""
+        url = self.search_url + f"/search?searchString={name}"
+        r = await self.session.get(url, headers=self.headers)
+        log_request(logger,
+                    r,
+                    message="HTTP request to Species API",
+                    request_headers_to_strip_away=[API_KEY_HTTP_HEADER])
+        if r.status_code == 200:
+            for d in r.json():
+                if exact_match:
+                    if d['swedishName'] == name.lower():
+                        return [d]
+                else:
+                    return r.json()
+        else:
+            return None
+
+    async def taxon_by_id(self, id):
+        """Returns the taxon with the given id."""
+        url = self.search_url + f"?taxa={id}"
+        r = await self.session.get(url, headers=self.headers)
+        log_request(logger,
+                    r,
+                    message="HTTP request to Species API",
+                    request_headers_to_strip_away=[API_KEY_HTTP_HEADER])
+        if r.json() == []:
+            return None
+        else:
+            return r.json()
+
+
+class AsyncObservationsAPI:
+    """Handles async requests to Artportalens Observations Service API."""
+
+    # See the Observation object in the API for alternative attributes to sort by.
+    DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS = 'event.startDate'
+
+    def __init__(self, api_key: str, session: AsyncApiSession = None):
+        """Initialization. The client is responsible for managing secrets. If no `session` is
+           given the object gets its own pooled session."""
+        self.key = api_key
+        self.session = session or AsyncApiSession()
+        self.url = API_ROOT_URL + "/species-observation-system/v1/"
+        self.search_url = self.url + "Observations/Search"
+        self.observation_url = self.url + "Observations/{id}"
+        self.headers = auth_headers(self.key)
+        self.last_response = None
+
+    async def version(self):
+        """Returns version of the API. This can be used to ping the API."""
+        url = self.url + "api/ApiInfo"
+        r = await self.session.get(url, headers=self.headers)
+        log_request(logger,
+                    r,
+                    message="HTTP request to Observations API",
+                    request_headers_to_strip_away=[API_KEY_HTTP_HEADER])
+        return r.json()
+
+    async def data_providers(self):
+        """Returns a list of data providers that have observations in the API."""
+        url = self.url + "/DataProviders"
+        r = await self.session.get(url, headers=self.headers)
+        log_request(logger,
+                    r,
+                    message="HTTP request to Observations API",
+                    request_headers_to_strip_away=[API_KEY_HTTP_HEADER])
+        return r.json()
+
+    @retry(
+        retry=retry_if_exception(_is_429_http_error),
+        stop=stop_after_attempt(5),
+        wait=wait_retry_after,
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    )
+    async def observations(self, searchFilter: SearchFilter,
+                           skip: int = 0,
+                           take: int = 100,  # Maximum is 1000
+                           sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                           sort_descending: bool = True,
+                           validateSearchFilter: bool = False,    # Validation will be done.
+                           translationCultureCode: str = None,    # "sv-SE" or "en-GB"
+                           # If the below is true, only sensitive observations will be searched
+                           sensitiveObservations: bool = False):
+        """Returns `take` observations starting at `skip` + 1 according to the criteria in
+           the `search_filter` and the other request parameters. See
+           client.ObservationsAPI.observations()."""
+        if sort_descending:
+            sortOrder = 'Desc'
+        else:
+            sortOrder = 'Asc'
+        url = self.search_url
+        params = {"skip": skip,
+                  "take": take,
+                  "sortBy": sortBy,
+                  "sortOrder": sortOrder,
+                  "validateSearchFilter": validateSearchFilter}
+        # httpx sends None valued parameters as empty strings, so leave them out
+        if translationCultureCode:
+            params["translationCultureCode"] = translationCultureCode
+        headers = self.headers | {"Content-Type": "application/json"}
+        try:
+            r = await self.session.post(url,
+                                        params=params,
+                                        headers=headers,
+                                        content=searchFilter.json_string())
+            logger.info("Call to artportalen.async_client.observations()",
+                        extra={"attributes": {"searchFilter": searchFilter.filter,
+                                              "skip": skip,
+                                              "take": take,
+                                              "sortBy": sortBy,
+                                              "sort_descending": sort_descending,
+                                              "validateSearchFilter": validateSearchFilter,
+                                              "translationCultureCode": translationCultureCode,
+                                              "sensitiveObservations": sensitiveObservations}})
+            log_request(logger,
+                        r,
+                        message="HTTP request to Observations API",
+                        request_headers_to_strip_away=[API_KEY_HTTP_HEADER])
+            self.last_response = r
+
+            # If the request triggered the rate limit, raise HTTPStatusError tied to this
+            # response so tenacity can retry. If not ok, raise an exception that will not be
+            # retried by tenacity.
+            r.raise_for_status()
+
+            # The response is ok, so return the JSON in the response body
+            with timing.stage("decode"):
+                return r.json()
+
+        except httpx.HTTPStatusError as e:
+            logger.warning("HTTPStatusError in artportalen.async_client.observations()",
+                           extra={"exception": e})
+            raise
+        except Exception as e:
+            # Log unexpected errors and propagate (so caller can handle).
+            logger.error("Exception caught in artportalen.async_client.observations()",
+                         exc_info=True,
+                         extra={"exception": e})
+            raise
+
+    async def observation_by_id(self, id: str, outputFieldSet: str):
+        """Returns the observation with the given `id`, where `outputFieldSet` specifies how many
+           attributes with values to return for the observation."""
+        if outputFieldSet not in API_OUTPUTFIELDSET_VALUES:
+            return None
+        url = self.observation_url.replace("{id}", id)
+        params = {"outputFieldSet": outputFieldSet,
+                  "translationCultureCode": "sv-SE",
+                  "sensitiveObservations": "false",
+                  "resolveGeneralizedObservations": "false"}
+        headers = self.headers | {"Content-Type": "application/json"}
+        try:
+            r = await self.session.get(url, params=params, headers=headers)
+            r.raise_for_status()
+            logger.info("Call to artportalen.async_client.observation_by_id()",
+                        extra={"attributes": {"id": id,
+                                              "outputFieldSet": outputFieldSet}})
+            log_request(logger,
+                        r,
+                        message="HTTP request to Observations API",
+                        request_headers_to_strip_away=[API_KEY_HTTP_HEADER])
+            self.last_response = r
+        except httpx.HTTPStatusError as e:
+            logger.warning("HTTPStatusError in artportalen.async_client.observation_by_id()",
+                           extra={"exception": e})
+        except Exception as e:
+            logger.error("Exception caught in artportalen.async_client.observation_by_id()",
+                         exc_info=True,
+                         extra={"exception": e})
+            return None
+        else:
+            return r.json()
@@ -0,0 +1,978 @@
+"""
+Module for the local cache database of Artportalen observations. There is one DuckDB database
+file per area, with the observations of the area as returned by the Artportalen Observations API.
+The JSON objects of the API are stored flattened, with one column per attribute, where underscore
+characters '_' in the column names separate the names of nested JSON attributes (see
+cache/sql/artportalen.001_init.sql).
+
+The schema is created and migrated with the numbered SQL files "artportalen.NNN_*.sql" in the
+cache schema directory, which are applied in order. The number of the last applied file is kept
+in the cache_metadata table, along with when the observations were last synchronized with the
+API.
+
+A synchronization doesn't write to the database file the web app reads. It writes to a copy of it,
+a new generation "artportalen.<area>.NNNNNN.duckdb", which is published by atomically replacing
+the pointer file "artportalen.<area>.current" with one that names the new generation. Read-only
+connections switch to the new generation between requests (see DuckDBCache.refresh()), so reads
+never wait for writes. Without a pointer file the database file is "artportalen.<area>.duckdb".
+"""
+
+from __future__ import annotations
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from enum import StrEnum
+from pathlib import Path
+from typing import Iterator
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_FILE_PATTERN = re.compile(r"^artportalen\.(\d{3})_.*\.sql$")
+GENERATION_FILE_PATTERN = re.compile(r"^artportalen\.(.+)\.(\d{6})\.duckdb$")
+
+# Keys in the cache_metadata table
+SCHEMA_VERSION_KEY = "schema_version"
+SYNCED_AT_KEY = "synced_at"
+MODIFIED_WATERMARK_KEY = "modified_watermark"
+SPECIES_SUMMARY_YEARS_KEY = "species_summary_years"
+CHANGES_SINCE_KEY = "changes_since"
+
+# The API never returns more observations than this in one search result page
+MAX_OBSERVATIONS = 1000
+
+# The columns needed to present observations in the daily list (see model.py). Converting column
+# values to Python objects is the bulk of the time of reading observations, so reading only
+# these is several times faster than reading all columns. observation_recorded_by has the same
+# columns (see schema file 003), so a change here needs a new schema file.
+LIST_COLUMNS = ["datasetName",
+                "event_startDate",
+                "event_endDate",
+                "location_county_name",
+                "location_decimalLatitude",
+                "location_decimalLongitude",
+                "location_locality",
+                "location_municipality_name",
+                "occurrence_activity_value",
+                "occurrence_individualCount",
+                "occurrence_lifeStage_value",
+                "occurrence_occurrenceId",
+                "occurrence_organismQuantity",
+                "occurrence_recordedBy",
+                "occurrence_sex_id",
+                "occurrence_url",
+                "taxon_attributes_isRedlisted",
+                "taxon_attributes_redlistCategory",
+                "taxon_scientificName",
+                "taxon_vernacularName"]
+
+# The search for the daily list is prepared in every cursor of the cursor pool, since planning it
+# is a significant part of its time. The parameters are the earliest start date, the from date,
+# the to date and the maximum number of observations.
+DAILY_LIST_STATEMENT = "daily_list"
+DAILY_LIST_SQL = f"""
+    SELECT {", ".join(LIST_COLUMNS)} FROM observations
+    WHERE event_plainStartDate BETWEEN $1 AND $3
+      AND event_plainEndDate >= $2
+    ORDER BY event_startDate DESC
+    LIMIT $4"""
+
+# The rows of observation_recorded_by for the observations in the table or query {source}: one row
+# per person in occurrence_recordedBy, with the name trimmed and its whitespace collapsed (see
+# normalized_person_name()), and the LIST_COLUMNS of the observation. Schema file 003 creates the
+# same rows for existing observations.
+RECORDED_BY_ROWS_SQL = r"""
+    SELECT DISTINCT ON (occurrence_occurrenceId, person_name) *
+    FROM (SELECT trim(regexp_replace(unnest(string_split(occurrence_recordedBy, ',')),
+                                     '\s+', ' ', 'g')) AS person_name,
+                 event_plainStartDate,
+                 {list_columns}
+          FROM {source})
+    WHERE person_name <> ''
+    ORDER BY person_name, event_startDate DESC"""
+
+
+MONTH_NAMES = ["january", "february", "march", "april", "may", "june",
+               "july", "august", "september", "october", "november", "december"]
+
+# The rarity classification of a species, for the whole year or for a month, by the share of the
+# years with observations of any species in the area in which the species has been observed (in
+# that month). The first classification with a share at least as large applies.
+RARITY_CLASSIFICATIONS = [(0.65, "Very common"),
+                          (0.25, "Common"),
+                          (0.12, "Uncommon"),
+                          (0.06, "Rare"),
+                          (0.0, "Very rare")]
+
+# The core period of a species is between these quantiles of the days of the year of its
+# observations
+CORE_PERIOD_QUANTILES = (0.1, 0.9)
+
+
+def _mm_dd_sql(day_of_year: str) -> str:
+    """SQL for the day of a leap year `day_of_year` (an SQL expression) in "MM-DD" format."""
+    return f"strftime(DATE '2000-01-01' + CAST(round({day_of_year}) AS INTEGER) - 1, '%m-%d')"
+
+
+def _rarity_sql(years: str) -> str:
+    """SQL for the rarity classification of a species observed in `years` (an SQL expression)
+       of the area's years with observations."""
+    cases = " ".join(f"WHEN {years} >= {share} * area.years THEN '{classification}'"
+                     for share, classification in RARITY_CLASSIFICATIONS)
+    return f"CASE {cases} END"
+
+
+# The rows of species_summary (see schema file 004) for the taxa with observations in the
+# observations table that satisfy the condition {taxon_condition}. Dates are compared by their
+# day of a leap year, so that e.g. March 1st is the same day every year. Only the "Total" category
+# (all observations of the species) is computed.
+SPECIES_SUMMARY_SQL = f"""
+    WITH obs AS (
+      SELECT taxon_id,
+             taxon_vernacularName,
+             taxon_scientificName,
+             event_plainStartDate AS d,
+             year(event_plainStartDate) AS y,
+             month(event_plainStartDate) AS m,
+             dayofyear(make_date(2000, month(event_plainStartDate), day(event_plainStartDate)))
+               AS doy
+      FROM observations
+      WHERE taxon_id IS NOT NULL AND {{taxon_condition}}),
+    area AS (
+      SELECT count(DISTINCT year(event_plainStartDate)) AS years FROM observations),
+    per_year AS (
+      SELECT taxon_id, y, count(*) AS n, min(doy) AS first_doy, max(doy) AS last_doy
+      FROM obs GROUP BY taxon_id, y),
+    yearly AS (
+      SELECT taxon_id,
+             count(*) AS years,
+             count(*) FILTER (WHERE n >= 5) AS years5,
+             min(first_doy) AS min_first_doy,
+             median(first_doy) AS median_first_doy,
+             avg(first_doy) AS avg_first_doy,
+             max(last_doy) AS max_last_doy,
+             median(last_doy) AS median_last_doy,
+             avg(last_doy) AS avg_last_doy,
+             CASE WHEN max(y) > min(y)
+                  THEN regr_slope(first_doy, y) * (max(y) - min(y)) END AS arrival_trend
+      FROM per_year GROUP BY taxon_id),
+    monthly AS (
+      SELECT taxon_id,
+             {", ".join(f"count(*) FILTER (WHERE m = {i + 1}) AS n_{name}"
+                        for i, name in enumerate(MONTH_NAMES))},
+             {", ".join(f"count(DISTINCT y) FILTER (WHERE m = {i + 1}) AS years_{name}"
+                        for i, name in enumerate(MONTH_NAMES))}
+      FROM obs GROUP BY taxon_id),
+    totals AS (
+      SELECT taxon_id,
+             arg_max(taxon_vernacularName, d) AS taxon_vernacularName,
+             arg_max(taxon_scientificName, d) AS taxon_scientificName,
+             count(*) AS n,
+             min(d) AS earliest_date,
+             max(d) AS latest_date,
+             quantile_cont(doy, {CORE_PERIOD_QUANTILES[0]}) AS core_start_doy,
+             quantile_cont(doy, {CORE_PERIOD_QUANTILES[1]}) AS core_end_doy
+      FROM obs GROUP BY taxon_id)
+    SELECT 'Total',
+           taxon_id,
+           totals.taxon_vernacularName,
+           totals.taxon_scientificName,
+           totals.n,
+           yearly.years,
+           yearly.years5,
+           yearly.years,
+           totals.earliest_date,
+           totals.latest_date,
+           {_mm_dd_sql("yearly.min_first_doy")},
+           {_mm_dd_sql("yearly.median_first_doy")},
+           {_mm_dd_sql("yearly.avg_first_doy")},
+           {_mm_dd_sql("yearly.max_last_doy")},
+           {_mm_dd_sql("yearly.median_last_doy")},
+           {_mm_dd_sql("yearly.avg_last_doy")},
+           {_mm_dd_sql("totals.core_start_doy")},
+           {_mm_dd_sql("totals.core_end_doy")},
+           CAST(round(yearly.arrival_trend) AS INTEGER),
+           {", ".join(f"monthly.n_{name}" for name in MONTH_NAMES)},
+           {_rarity_sql("yearly.years")},
+           {", ".join(_rarity_sql(f"monthly.years_{name}") for name in MONTH_NAMES)}
+    FROM totals
+      JOIN yearly USING (taxon_id)
+      JOIN monthly USING (taxon_id)
+      CROSS JOIN area
+    ORDER BY totals.n DESC"""
+
+
+class CacheOpenMode(StrEnum):
+    # Open an existing database for reading and writing, and apply any new schema files
+    OPEN = "open"
+    # Create the database if it doesn't exist, and apply any new schema files
+    CREATE = "create"
+    # Open an existing database for reading only
+    READ_ONLY = "read_only"
+
+
+class SpeciesSortKey(StrEnum):
+    NAME = "name"
+    OBSERVATIONS = "observations"
+    EARLIEST_DATE = "earliest_date"
+    LATEST_DATE = "latest_date"
+    # Sorted descending, the rarest species come first
+    RARITY = "rarity"
+
+
+_RARITY_RANK_SQL = "CASE rarity_classification {} END".format(
+    " ".join(f"WHEN '{classification}' THEN {rank}"
+             for rank, (_, classification) in enumerate(RARITY_CLASSIFICATIONS)))
+
+SPECIES_SORT_EXPRESSIONS = {SpeciesSortKey.NAME: "taxon_vernacularName",
+                            SpeciesSortKey.OBSERVATIONS: "observations",
+                            SpeciesSortKey.EARLIEST_DATE: "earliest_date",
+                            SpeciesSortKey.LATEST_DATE: "latest_date",
+                            SpeciesSortKey.RARITY: _RARITY_RANK_SQL}
+
+
+# The searches for the pages of the species summary are prepared in every cursor of the cursor
+# pool, like the daily list, with a statement for each sort key and direction. The parameters are
+# the lowercase name prefix, or NULL for all species, and for the pages the number of rows to take
+# and skip.
+SPECIES_COUNT_STATEMENT = "species_count"
+SPECIES_CONDITION_SQL = "($1 IS NULL OR starts_with(lower(taxon_vernacularName), $1))"
+SPECIES_COUNT_SQL = f"SELECT count(*) FROM species_summary WHERE {SPECIES_CONDITION_SQL}"
+
+
+def species_page_statement(sort_key: SpeciesSortKey, descending: bool) -> str:
+    """The name of the prepared statement for the pages of the species summary sorted on
+       `sort_key`."""
+    return f"species_page_{sort_key.value}_{'desc' if descending else 'asc'}"
+
+
+def species_page_sql(sort_key: SpeciesSortKey, descending: bool) -> str:
+    """The search for the pages of the species summary sorted on `sort_key`."""
+    return f"""
+        SELECT * FROM species_summary
+        WHERE {SPECIES_CONDITION_SQL}
+        ORDER BY {SPECIES_SORT_EXPRESSIONS[sort_key]} {"DESC" if descending else "ASC"} NULLS LAST,
+                 taxon_vernacularName, taxon_id
+        LIMIT $2 OFFSET $3"""
+
+
+def normalized_person_name(name: str) -> str:
+    """`name` as stored in the person_name column of observation_recorded_by."""
+    return " ".join(name.split())
+
+
+def schema_files(schema_dir: Path) -> list[tuple[int, Path]]:
+    """The numbered schema files in `schema_dir`, as (number, path) tuples in order."""
+    result = []
+    for path in Path(schema_dir).glob("artportalen.*.sql"):
+        m = SCHEMA_FILE_PATTERN.match(path.name)
+        if m:
+            result.append((int(m.group(1)), path))
+    return sorted(result)
+
+
+def database_path(settings, area_name: str) -> Path:
+    """The path of the database file of the area `area_name` when there are no generations."""
+    return Path(settings.CACHE_DATABASE_DIR) / f"artportalen.{area_name}.duckdb"
+
+
+def generation_pointer_path(settings, area_name: str) -> Path:
+    """The path of the file with the name of the current generation of the database of the area
+       `area_name`."""
+    return Path(settings.CACHE_DATABASE_DIR) / f"artportalen.{area_name}.current"
+
+
+def generations(settings, area_name: str) -> list[tuple[int, Path]]:
+    """The generations of the database of the area `area_name`, published or not, as
+       (number, path) tuples in order."""
+    result = []
+    for path in Path(settings.CACHE_DATABASE_DIR).glob(f"artportalen.{area_name}.*.duckdb"):
+        m = GENERATION_FILE_PATTERN.match(path.name)
+        if m and m.group(1) == area_name:
+            result.append((int(m.group(2)), path))
+    return sorted(result)
+
+
+def current_database_path(settings, area_name: str) -> Path:
+    """The path of the current generation of the database of the area `area_name`."""
+    pointer = generation_pointer_path(settings, area_name)
+    try:
+        name = pointer.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return database_path(settings, area_name)
+    return pointer.parent / name
+
+
+def _fsync(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def new_generation(settings, area_name: str) -> Path:
+    """The path of a new generation of the database of the area `area_name`, which is a copy of
+       the current generation, or doesn't exist if there is no current generation. Only one
+       generation should be built at a time."""
+    existing = generations(settings, area_name)
+    number = existing[-1][0] + 1 if existing else 1
+    path = Path(settings.CACHE_DATABASE_DIR) / f"artportalen.{area_name}.{number:06d}.duckdb"
+    current = current_database_path(settings, area_name)
+    if current.exists():
+        shutil.copyfile(current, path)
+    return path
+
+
+def publish_generation(settings, area_name: str, path: Path):
+    """Make the database file `path` the current generation of the database of the area
+       `area_name`. The pointer file is replaced atomically, so readers see either the previous
+       generation or the new one. The previous generation is kept for readers that haven't
+       switched yet, and older ones are removed."""
+    previous = current_database_path(settings, area_name)
+    _fsync(path)
+    pointer = generation_pointer_path(settings, area_name)
+    tmp = pointer.with_name(pointer.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(path.name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, pointer)
+    logger.info(f"Published cache database {path}")
+    published = int(GENERATION_FILE_PATTERN.match(path.name).group(2))
+    for number, p in generations(settings, area_name):
+        if number < published and p.name != previous.name:
+            p.unlink(missing_ok=True)
+
+
+def _sql_literal(value: date | int | str | None) -> str:
+    """`value` as an SQL literal, for the arguments of EXECUTE, which can't have parameters."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return str(int(value))
+
+
+class _Generation:
+    """The cursors of one connection of a CursorPool, and the number of them in use, including
+       checkouts waiting for a cursor."""
+
+    def __init__(self, conn: duckdb.DuckDBPyConnection):
+        """Initialization."""
+        self.conn = conn
+        self.idle = queue.LifoQueue()
+        self.size = 0
+        self.in_use = 0
+
+
+class CursorPool:
+    """A pool of at most `maxsize` cursors of a DuckDB connection, for searches from many
+       threads. A DuckDB cursor is a connection of its own to the same database, so pooled
+       cursors keep their prepared statements and aren't created for every search. The
+       connection can be replaced, e.g. by a new generation of the database, without losing the
+       counters of the pool."""
+
+    def __init__(self, conn: duckdb.DuckDBPyConnection, maxsize: int):
+        """Initialization."""
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._generation = _Generation(conn)
+        # Replaced generations with cursors still in use
+        self._retired: set[_Generation] = set()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+
+    def replace(self, conn: duckdb.DuckDBPyConnection):
+        """Make new cursors from `conn`. The previous connection is closed as soon as none of its
+           cursors are in use, so searches running on it can finish."""
+        with self._lock:
+            retired = self._generation
+            self._generation = _Generation(conn)
+            if retired.in_use:
+                self._retired.add(retired)
+                return
+        retired.conn.close()
+
+    def _new_cursor(self, conn: duckdb.DuckDBPyConnection) -> duckdb.DuckDBPyConnection:
+        cursor = conn.cursor()
+        cursor.execute(f"PREPARE {DAILY_LIST_STATEMENT} AS {DAILY_LIST_SQL}")
+        # Databases from before schema file 004 have no species summary
+        cursor.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = 'species_summary'")
+        if cursor.fetchone()[0]:
+            cursor.execute(f"PREPARE {SPECIES_COUNT_STATEMENT} AS {SPECIES_COUNT_SQL}")
+            for sort_key in SpeciesSortKey:
+                for descending in (False, True):
+                    cursor.execute(f"PREPARE {species_page_statement(sort_key, descending)} AS "
+                                   f"{species_page_sql(sort_key, descending)}")
+        return cursor
+
+    @contextmanager
+    def cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        """A cursor from the pool, to be used in a with statement. Waits for a cursor to be
+           returned if all `maxsize` of them are in use."""
+        tic = time.perf_counter()
+        with self._lock:
+            generation = self._generation
+            generation.in_use += 1
+            create = generation.idle.empty() and generation.size < self.maxsize
+            if create:
+                generation.size += 1
+        try:
+            if create:
+                cursor = self._new_cursor(generation.conn)
+            else:
+                try:
+                    cursor = generation.idle.get_nowait()
+                except queue.Empty:
+                    cursor = generation.idle.get()
+                    with self._lock:
+                        self._waits += 1
+            with self._lock:
+                self._checkouts += 1
+                self._wait_seconds += time.perf_counter() - tic
+            try:
+                yield cursor
+            finally:
+                # Returned to its own generation, where checkouts waiting for a cursor of a
+                # replaced connection get it
+                generation.idle.put(cursor)
+        finally:
+            self._release(generation)
+
+    def _release(self, generation: _Generation):
+        with self._lock:
+            generation.in_use -= 1
+            if generation.in_use or generation not in self._retired:
+                return
+            self._retired.discard(generation)
+        generation.conn.close()
+
+    def close(self):
+        """Close the replaced connections that still have cursors in use. The current connection
+           is closed by its owner."""
+        with self._lock:
+            retired = list(self._retired)
+            self._retired.clear()
+        for generation in retired:
+            generation.conn.close()
+
+    def stats(self) -> dict:
+        """The number of cursors checked out, how many of those had to wait for a cursor, the
+           total time spent waiting, the current number of cursors, and the number of replaced
+           connections that are kept open until their cursors are returned."""
+        with self._lock:
+            return {"checkouts": self._checkouts,
+                    "waits": self._waits,
+                    "wait_seconds": round(self._wait_seconds, 3),
+                    "size": self._generation.size,
+                    "retired": len(self._retired)}
+
+
+def _json_value(value):
+    """`value` as returned by the API, i.e. dates and timestamps as ISO 8601 strings."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def json_structure(column_types: list[tuple[str, str]]) -> dict:
+    """The JSON structure of an observation as returned by the API, with the column types as
+       leaves, for the columns and types in `column_types`. This is the structure argument of
+       DuckDB's from_json() function."""
+    result = {}
+    for column, column_type in column_types:
+        path = column.split("_")
+        d = result
+        for name in path[:-1]:
+            d = d.setdefault(name, {})
+        d[path[-1]] = column_type
+    return result
+
+
+def unflattened(columns: list[tuple[str, ...]], row: tuple) -> dict:
+    """The observation in `row` as a nested dictionary like the one returned by the API, where
+       `columns` are the column names of the row split on '_'. Attributes with NULL values are
+       left out, as they are in the API."""
+    result = {}
+    for path, value in zip(columns, row):
+        if value is None:
+            continue
+        d = result
+        for name in path[:-1]:
+            d = d.setdefault(name, {})
+        d[path[-1]] = _json_value(value)
+    return result
+
+
+class DuckDBCache:
+    """The cache database of Artportalen observations for an area."""
+
+    def __init__(self,
+                 settings,
+                 area_name: str,
+                 open_mode: CacheOpenMode = CacheOpenMode.OPEN,
+                 path: Path = None):
+        """Initialization. Opens the database file `path`, by default the current generation of
+           the database for the area `area_name` in the cache database directory, according to
+           `open_mode`."""
+        self.settings = settings
+        self.area_name = area_name
+        self.open_mode = open_mode
+        self.path = Path(path) if path else current_database_path(settings, area_name)
+        if open_mode != CacheOpenMode.CREATE and not self.path.exists():
+            raise FileNotFoundError(f"No cache database {self.path}")
+        self.conn = duckdb.connect(str(self.path),
+                                   read_only=(open_mode == CacheOpenMode.READ_ONLY))
+        self.pool = CursorPool(self.conn, settings.CACHE_DATABASE_POOL_SIZE)
+        self._lock = threading.Lock()
+        self._max_observation_days = None
+        self._column_types = None
+        # The taxa whose rows in species_summary are out of date
+        self._dirty_taxon_ids = set()
+        if open_mode != CacheOpenMode.READ_ONLY:
+            self.migrate()
+        # Only this object can write to the database file while it is open, and a published
+        # generation is never written to, so the timestamp can be kept in memory instead of being
+        # read for every search
+        v = self.metadata(SYNCED_AT_KEY)
+        self._synced_at = datetime.fromisoformat(v) if v else None
+
+    def _cursor(self) -> duckdb.DuckDBPyConnection:
+        """A cursor for the calling thread. DuckDB connections must not be shared by threads,
+           but cursors of the same connection may be used concurrently."""
+        return self.conn.cursor()
+
+    def close(self):
+        """Close the database."""
+        self.pool.close()
+        self.conn.close()
+
+    def refresh(self) -> bool:
+        """Switch to the current generation of the database, if it is opened read-only and a new
+           generation has been published since it was opened. Returns True if it switched.
+           Searches that are running on the previous generation finish on it, its connection is
+           closed when they have (see CursorPool.replace())."""
+        if self.open_mode != CacheOpenMode.READ_ONLY:
+            return False
+        path = current_database_path(self.settings, self.area_name)
+        if path == self.path:
+            return False
+        with self._lock:
+            if path == self.path:
+                return False
+            conn = duckdb.connect(str(path), read_only=True)
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM cache_metadata WHERE key = ?", [SYNCED_AT_KEY])
+            row = cursor.fetchone()
+            self.conn = conn
+            self.pool.replace(conn)
+            self.path = path
+            self._max_observation_days = None
+            self._column_types = None
+            self._synced_at = datetime.fromisoformat(row[0]) if row else None
+        logger.info(f"Switched to cache database {path}")
+        return True
+
+    def _has_table(self, cursor, name: str) -> bool:
+        cursor.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [name])
+        return cursor.fetchone()[0] > 0
+
+    def metadata(self, key: str) -> str | None:
+        """The value of `key` in the cache_metadata table, or None if there is none."""
+        cursor = self._cursor()
+        if not self._has_table(cursor, "cache_metadata"):
+            return None
+        cursor.execute("SELECT value FROM cache_metadata WHERE key = ?", [key])
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_metadata(self, key: str, value: str):
+        """Set the value of `key` in the cache_metadata table."""
+        self._cursor().execute("INSERT OR REPLACE INTO cache_metadata VALUES (?, ?)",
+                               [key, value])
+
+    def schema_version(self) -> int:
+        """The number of the last schema file applied to the database."""
+        v = self.metadata(SCHEMA_VERSION_KEY)
+        return int(v) if v else 0
+
+    def migrate(self):
+        """Apply the schema files that haven't been applied to the database yet, in order."""
+        self._cursor().execute("CREATE TABLE IF NOT EXISTS cache_metadata "
+                               "(key VARCHAR PRIMARY KEY, value VARCHAR)")
+        version = self.schema_version()
+        for number, path in schema_files(self.settings.CACHE_SCHEMA_DIR):
+            if number <= version:
+                continue
+            logger.info(f"Applying {path.name} to cache database {self.path}")
+            cursor = self._cursor()
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                cursor.execute(path.read_text(encoding="utf-8"))
+                cursor.execute("INSERT OR REPLACE INTO cache_metadata VALUES (?, ?)",
+                               [SCHEMA_VERSION_KEY, str(number)])
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def synced_at(self) -> datetime | None:
+        """When the observations in the database were last synchronized with the API, or None
+           if they never have been."""
+        return self._synced_at
+
+    def set_synced_at(self, timestamp: datetime = None):
+        """Record that the observations in the database were synchronized with the API at
+           `timestamp` (default now)."""
+        timestamp = timestamp or datetime.now(timezone.utc)
+        self.set_metadata(SYNCED_AT_KEY, timestamp.isoformat())
+        self._synced_at = timestamp
+
+    def timestamp(self) -> str:
+        """When the database was last synchronized with the API, in "YYYY-MM-DD HH:MM:SS"
+           format."""
+        synced_at = self.synced_at()
+        if synced_at is None:
+            return "never"
+        return synced_at.astimezone().strftime("%Y-%m-%d %H:%M:%S")
+
+    def modified_watermark(self) -> datetime | None:
+        """The high-water mark of delta syncs: all observations modified before it are in the
+           database. None if the database has never been synchronized."""
+        v = self.metadata(MODIFIED_WATERMARK_KEY)
+        return datetime.fromisoformat(v) if v else None
+
+    def set_modified_watermark(self, timestamp: datetime):
+        """Set the high-water mark of delta syncs."""
+        self.set_metadata(MODIFIED_WATERMARK_KEY, timestamp.isoformat())
+
+    def covered_to_date(self) -> date | None:
+        """The last date for which the observations in the database are complete. Observations
+           within the freshness window before the last synchronization may still be added,
+           changed or validated in Artportalen, so they must be fetched from the API. None if the
+           database has never been synchronized."""
+        synced_at = self.synced_at()
+        if synced_at is None:
+            return None
+        days = self.settings.CACHE_DATABASE_FRESHNESS_DAYS
+        return synced_at.astimezone().date() - timedelta(days=days)
+
+    def covers(self, from_date: str, to_date: str) -> bool:
+        """True if the database has all observations between `from_date` and `to_date` (in
+           "YYYY-MM-DD" format)."""
+        covered_to_date = self.covered_to_date()
+        return covered_to_date is not None and date.fromisoformat(to_date) <= covered_to_date
+
+    def max_observation_days(self) -> int:
+        """The longest time between the start date and the end date of an observation, in days.
+           It lets searches for overlapping dates be bounded on the start date, which the
+           observations are ordered and indexed by."""
+        with self._lock:
+            if self._max_observation_days is None:
+                with self.pool.cursor() as cursor:
+                    cursor.execute("SELECT coalesce(max(event_plainEndDate - "
+                                   "event_plainStartDate), 0) FROM observations")
+                    self._max_observation_days = cursor.fetchone()[0]
+            return self._max_observation_days
+
+    def column_types(self) -> list[tuple[str, str]]:
+        """The names and types of the columns of the observations table."""
+        if self._column_types is None:
+            cursor = self._cursor()
+            cursor.execute("SELECT column_name, data_type FROM duckdb_columns() "
+                           "WHERE table_name = 'observations' ORDER BY column_index")
+            self._column_types = cursor.fetchall()
+        return self._column_types
+
+    def upsert_observations(self, records: list[dict]) -> int:
+        """Insert the observation `records`, as returned by the API, into the observations table,
+           replacing the observations with the same occurrence id. Attributes without a column
+           in the table are ignored. Only one record per occurrence id in a batch is inserted.
+           Returns the number of records.
+           The whole batch is passed to DuckDB as one JSON document, which DuckDB's from_json()
+           turns into one typed column vector per attribute, so the records are staged and
+           inserted column by column instead of row by row. Replaced observations are deleted
+           and inserted again, which is much faster than updating them in place. The records are
+           inserted ordered by start date, to keep the zone maps of event_plainStartDate
+           selective. The observers of the records are split into rows in
+           observation_recorded_by. The taxa of the records, and of the observations they
+           replace, are marked for update_species_summary(), and their dates are recorded in
+           changed_dates."""
+        if not records:
+            return 0
+        column_types = self.column_types()
+        structure = json.dumps([json_structure(column_types)])
+        select_list = ", ".join(
+            "r." + ".".join(f'"{name}"' for name in column.split("_")) + f' AS "{column}"'
+            for column, _ in column_types)
+        cursor = self._cursor()
+        cursor.execute(f"""
+            CREATE OR REPLACE TEMP TABLE staged_observations AS
+            SELECT {select_list}
+            FROM (SELECT unnest(from_json(?, ?)) AS r)
+            QUALIFY row_number() OVER (PARTITION BY r.occurrence.occurrenceId) = 1""",
+                       [json.dumps(records), structure])
+        cursor.execute("BEGIN TRANSACTION")
+        try:
+            cursor.execute("""
+                SELECT taxon_id FROM staged_observations
+                UNION
+                SELECT taxon_id FROM observations
+                WHERE occurrence_occurrenceId IN
+                  (SELECT occurrence_occurrenceId FROM staged_observations)""")
+            taxon_ids = {row[0] for row in cursor.fetchall() if row[0] is not None}
+            cursor.execute("""
+                INSERT INTO changed_dates
+                SELECT event_plainStartDate, event_plainEndDate FROM staged_observations
+                UNION
+                SELECT event_plainStartDate, event_plainEndDate FROM observations
+                WHERE occurrence_occurrenceId IN
+                  (SELECT occurrence_occurrenceId FROM staged_observations)""")
+            for table in ["observations", "observation_recorded_by"]:
+                cursor.execute(f"""
+                    DELETE FROM {table}
+                    WHERE occurrence_occurrenceId IN
+                      (SELECT occurrence_occurrenceId FROM staged_observations)""")
+            cursor.execute("""
+                INSERT INTO observations
+                SELECT * FROM staged_observations
+                ORDER BY event_plainStartDate, event_startDate""")
+            cursor.execute("INSERT INTO observation_recorded_by " +
+                           RECORDED_BY_ROWS_SQL.format(source="staged_observations",
+                                                       list_columns=", ".join(LIST_COLUMNS)))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS staged_observations")
+        with self._lock:
+            self._max_observation_days = None
+        self._dirty_taxon_ids |= taxon_ids
+        return len(records)
+
+    def begin_changes(self):
+        """Start recording the dates of the observations changed by a sync in changed_dates,
+           as changes since the last sync."""
+        cursor = self._cursor()
+        cursor.execute("DELETE FROM changed_dates")
+        synced_at = self.synced_at()
+        self.set_metadata(CHANGES_SINCE_KEY, synced_at.isoformat() if synced_at else "")
+
+    def changed_date_ranges(self, since: datetime | None) -> list[tuple[date, date]] | None:
+        """The date ranges, as (from date, to date) tuples, of the observations changed since
+           the database was synchronized at `since`. None if the changes since then aren't
+           known, e.g. because the database has been synchronized more than once since then."""
+        if since is None or self.metadata(CHANGES_SINCE_KEY) != since.isoformat():
+            return None
+        with self.pool.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT from_date, to_date FROM changed_dates")
+            return cursor.fetchall()
+
+    def update_species_summary(self) -> int:
+        """Recompute the rows of species_summary of the taxa with observations upserted since
+           the last update. All rows are recomputed if the table is empty, or if the number of
+           years with observations in the area has changed, since the rarity classifications of
+           all species depend on it. Returns the number of rows recomputed."""
+        cursor = self._cursor()
+        cursor.execute("SELECT count(DISTINCT year(event_plainStartDate)) FROM observations")
+        area_years = str(cursor.fetchone()[0])
+        cursor.execute("SELECT count(*) FROM species_summary")
+        full = cursor.fetchone()[0] == 0 or self.metadata(SPECIES_SUMMARY_YEARS_KEY) != area_years
+        if not full and not self._dirty_taxon_ids:
+            return 0
+        tic = time.perf_counter()
+        cursor.execute("BEGIN TRANSACTION")
+        try:
+            if full:
+                cursor.execute("DELETE FROM species_summary")
+                cursor.execute("INSERT INTO species_summary " +
+                               SPECIES_SUMMARY_SQL.format(taxon_condition="TRUE"))
+            else:
+                taxon_ids = sorted(self._dirty_taxon_ids)
+                cursor.execute("DELETE FROM species_summary WHERE list_contains(?, taxon_id)",
+                               [taxon_ids])
+                cursor.execute("INSERT INTO species_summary " +
+                               SPECIES_SUMMARY_SQL.format(
+                                   taxon_condition="list_contains(?, taxon_id)"),
+                               [taxon_ids])
+            cursor.execute("INSERT OR REPLACE INTO cache_metadata VALUES (?, ?)",
+                           [SPECIES_SUMMARY_YEARS_KEY, area_years])
+            cursor.execute("SELECT count(*) FROM species_summary")
+            n = cursor.fetchone()[0] if full else len(taxon_ids)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        self._dirty_taxon_ids = set()
+        logger.info(f"Updated species summary in cache database {self.path}",
+                    extra={"attributes": {"full": full,
+                                          "taxa": n,
+                                          "seconds": round(time.perf_counter() - tic, 3)}})
+        return n
+
+    def cluster(self):
+        """Rebuild the observations table ordered by start date, and observation_recorded_by
+           ordered by person name. Upserts append rows at the end of the tables, which makes the
+           zone maps of those columns less selective, so this should be done after large syncs.
+           The tables are copied to new tables that replace the old ones, since deleting and
+           inserting all rows of a table with a primary key is very slow in DuckDB."""
+        cursor = self._cursor()
+        for table, order_by in [("observations", "event_plainStartDate, event_startDate"),
+                                ("observation_recorded_by", "person_name, event_startDate DESC")]:
+            tic = time.perf_counter()
+            cursor.execute("SELECT sql FROM duckdb_tables() WHERE table_name = ?", [table])
+            create_table = cursor.fetchone()[0]
+            cursor.execute("SELECT sql FROM duckdb_indexes() WHERE table_name = ?", [table])
+            create_indexes = [row[0] for row in cursor.fetchall()]
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                cursor.execute(create_table.replace(f"CREATE TABLE {table}(",
+                                                    f"CREATE TABLE {table}_clustered(", 1))
+                cursor.execute(f"INSERT INTO {table}_clustered "
+                               f"SELECT * FROM {table} ORDER BY {order_by}")
+                cursor.execute(f"DROP TABLE {table}")
+                cursor.execute(f"ALTER TABLE {table}_clustered RENAME TO {table}")
+                for create_index in create_indexes:
+                    cursor.execute(create_index)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            logger.info(f"Clustered {table} in cache database {self.path}",
+                        extra={"attributes": {"seconds": round(time.perf_counter() - tic, 3)}})
+
+    def observations(self,
+                     from_date: str,
+                     to_date: str,
+                     columns: list[str] = LIST_COLUMNS,
+                     take: int = MAX_OBSERVATIONS) -> dict:
+        """The observations between `from_date` and `to_date` (in "YYYY-MM-DD" format), in the
+           same form and order as the result from ObservationsAPI.observations() with the date
+           filter type "OverlappingStartDateAndEndDate", sorted on the start date descending.
+           Only the attributes in `columns` are read, or all of them if `columns` is None."""
+        from_d = date.fromisoformat(from_date)
+        to_d = date.fromisoformat(to_date)
+        earliest_start = from_d - timedelta(days=self.max_observation_days())
+        with self.pool.cursor() as cursor:
+            if columns == LIST_COLUMNS:
+                args = ", ".join(_sql_literal(v) for v in [earliest_start, from_d, to_d, take])
+                cursor.execute(f"EXECUTE {DAILY_LIST_STATEMENT}({args})")
+            else:
+                select_list = ", ".join(columns) if columns else "*"
+                cursor.execute(f"""
+                    SELECT {select_list} FROM observations
+                    WHERE event_plainStartDate BETWEEN ? AND ?
+                      AND event_plainEndDate >= ?
+                    ORDER BY event_startDate DESC
+                    LIMIT ?""", [earliest_start, to_d, from_d, take])
+            columns = [tuple(d[0].split("_")) for d in cursor.description]
+            rows = cursor.fetchall()
+        records = [unflattened(columns, row) for row in rows]
+        return {"skip": 0,
+                "take": take,
+                "totalCount": len(records),
+                "records": records}
+
+    def observations_by_observer(self,
+                                 observer_name: str,
+                                 from_date: str = None,
+                                 to_date: str = None,
+                                 skip: int = 0,
+                                 take: int = MAX_OBSERVATIONS) -> dict:
+        """The observations with `observer_name` among their observers, optionally only those
+           that start between `from_date` and `to_date` (in "YYYY-MM-DD" format), sorted on the
+           start date descending and in the same form as the result from
+           ObservationsAPI.observations(). Only the LIST_COLUMNS of the observations are read,
+           from observation_recorded_by."""
+        conditions = ["person_name = ?"]
+        params = [normalized_person_name(observer_name)]
+        if from_date:
+            conditions.append("event_plainStartDate >= ?")
+            params.append(date.fromisoformat(from_date))
+        if to_date:
+            conditions.append("event_plainStartDate <= ?")
+            params.append(date.fromisoformat(to_date))
+        where = " AND ".join(conditions)
+        with self.pool.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM observation_recorded_by WHERE {where}", params)
+            total_count = cursor.fetchone()[0]
+            cursor.execute(f"""
+                SELECT {", ".join(LIST_COLUMNS)} FROM observation_recorded_by
+                WHERE {where}
+                ORDER BY event_startDate DESC
+                LIMIT ? OFFSET ?""", params + [take, skip])
+            columns = [tuple(d[0].split("_")) for d in cursor.description]
+            rows = cursor.fetchall()
+        return {"skip": skip,
+                "take": take,
+                "totalCount": total_count,
+                "records": [unflattened(columns, row) for row in rows]}
+
+    def species_summary_page(self,
+                             sort_key: SpeciesSortKey = SpeciesSortKey.OBSERVATIONS,
+                             descending: bool = True,
+                             name_prefix: str = None,
+                             skip: int = 0,
+                             take: int = 50) -> dict:
+        """A page of the rows of species_summary, sorted on `sort_key`, optionally only the
+           species whose names start with `name_prefix` (ignoring case), in the same form as
+           the result from observations_by_observer(). No records if the database has no species
+           summary yet."""
+        prefix = _sql_literal(name_prefix.strip().lower() if name_prefix else None)
+        statement = species_page_statement(SpeciesSortKey(sort_key), descending)
+        with self.pool.cursor() as cursor:
+            if not self._has_table(cursor, "species_summary"):
+                return {"skip": skip, "take": take, "totalCount": 0, "records": []}
+            cursor.execute(f"EXECUTE {SPECIES_COUNT_STATEMENT}({prefix})")
+            total_count = cursor.fetchone()[0]
+            cursor.execute(f"EXECUTE {statement}({prefix}, {_sql_literal(take)}, "
+                           f"{_sql_literal(skip)})")
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        return {"skip": skip,
+                "take": take,
+                "totalCount": total_count,
+                "records": [dict(zip(columns, row)) for row in rows]}
+
+    def species_data(self) -> list[dict]:
+        """The rows of species_summary, as dictionaries with the column names as keys, ordered
+           by the number of observations descending. Empty if the database has no species
+           summary yet."""
+        with self.pool.cursor() as cursor:
+            if not self._has_table(cursor, "species_summary"):
+                return []
+            cursor.execute("SELECT * FROM species_summary ORDER BY observations DESC, taxon_id")
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+@contextmanager
+def snapshot(settings, area_name: str) -> Iterator[DuckDBCache]:
+    """A new generation of the database of the area `area_name`, opened for writing, to be used
+       in a with statement. Readers keep reading the current generation while it is updated.
+       The new generation is published when the with block exits without an exception, and
+       removed otherwise."""
+    path = new_generation(settings, area_name)
+    try:
+        cachedb = DuckDBCache(settings, area_name, CacheOpenMode.CREATE, path=path)
+        try:
+            yield cachedb
+        finally:
+            cachedb.close()
+    except BaseException:
+        path.unlink(missing_ok=True)
+        path.with_name(path.name + ".wal").unlink(missing_ok=True)
+        raise
+    publish_generation(settings, area_name, path)
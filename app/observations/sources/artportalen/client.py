@@ -4,7 +4,12 @@ Module for interacting with Artportalens API.
 
 from __future__ import annotations
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 import json
 from datetime import datetime, timedelta
@@ -14,7 +19,9 @@ from tenacity import (
 from dataclasses import dataclass
 from pprint import pformat
 # import app.utils.httplogs as httplogs
+from app.utils import timing
 from app.utils.logging import log_request
+from app.utils.ratelimit import RateLimiter, retry_after_seconds
 
 # Constants
 DEFAULT_FROM_DATE_RFC3339 = '1900-01-01T00:00'
@@ -100,6 +107,20 @@ def _is_429_http_error(e: Exception):
     )
 
 
+_wait_exponential = wait_exponential(multiplier=1, min=1, max=31)
+
+
+def wait_retry_after(retry_state) -> float:
+    """Tenacity wait strategy that waits as long as the "Retry-After" header of the 429 response
+       says (but at most 31 seconds), or backs off exponentially if there is no such header."""
+    e = retry_state.outcome.exception() if retry_state.outcome else None
+    response = getattr(e, "response", None)
+    seconds = retry_after_seconds(response.headers) if response is not None else None
+    seconds = _wait_exponential(retry_state) if seconds is None else min(seconds, 31)
+    timing.record("backoff", seconds)
+    return seconds
+
+
 class Taxon:
 
     def __init__(self):
@@ -129,12 +150,111 @@ def auth_headers(api_key, auth_token=None):
     return h
 
 
+@dataclass(frozen=True)
+class HTTPSessionConfig:
+    """Configuration of the pooled HTTP session used for requests to the Artportalen API:s.
+       `pool_maxsize` is the maximum number of kept-alive connections per host and should be at
+       least as large as the number of threads that call the API:s concurrently. The timeouts are
+       in seconds and are applied to every call, unless overridden in that call."""
+    pool_connections: int = 4
+    pool_maxsize: int = 16
+    pool_block: bool = False
+    keep_alive: bool = True
+    accept_encoding: str = "gzip, deflate"
+    connect_timeout: float = 3.05
+    read_timeout: float = 30.0
+
+    def timeout(self) -> tuple[float, float]:
+        """The (connect, read) timeout tuple used by `requests`."""
+        return (self.connect_timeout, self.read_timeout)
+
+
+class ApiSession:
+    """A pooled HTTP session with keep-alive connections to the Artportalen API:s. One instance
+       can be shared by SpeciesAPI and ObservationsAPI objects, and by multiple threads, so that
+       TCP and TLS handshakes to api.artdatabanken.se are only done when the pool needs a new
+       connection. If a `rate_limiter` is given, every request waits for a token from it, and a
+       429 response pauses all users of the rate limiter."""
+
+    def __init__(self, config: HTTPSessionConfig = None, rate_limiter: RateLimiter = None):
+        """Initialization."""
+        self.config = config or HTTPSessionConfig()
+        self.rate_limiter = rate_limiter
+        self.adapter = HTTPAdapter(pool_connections=self.config.pool_connections,
+                                   pool_maxsize=self.config.pool_maxsize,
+                                   pool_block=self.config.pool_block)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({
+            "Accept-Encoding": self.config.accept_encoding,
+            "Connection": "keep-alive" if self.config.keep_alive else "close"})
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def request(self, method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+        """Send a HTTP request with the session. `timeout` is either a number of seconds or a
+           (connect, read) tuple and defaults to the timeouts in the session config."""
+        if timeout is None:
+            timeout = self.config.timeout()
+        with self._lock:
+            self._requests += 1
+        if not self.rate_limiter:
+            with timing.stage("http"):
+                return self.session.request(method, url, timeout=timeout, **kwargs)
+
+        self.rate_limiter.acquire()
+        tic = time.perf_counter()
+        r = self.session.request(method, url, timeout=timeout, **kwargs)
+        seconds = time.perf_counter() - tic
+        self.rate_limiter.record_request(seconds)
+        timing.record("http", seconds)
+        if r.status_code == 429:
+            self.rate_limiter.pause(retry_after_seconds(r.headers))
+        return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Send a HTTP GET request with the session."""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Send a HTTP POST request with the session."""
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict[str, int]:
+        """Counters for the session. "handshakes" is the number of new connections (and thereby
+           TCP and TLS handshakes) made by the connection pools, and "reused_connections" is the
+           number of requests that were sent on an already open connection."""
+        pools = self.adapter.poolmanager.pools
+        handshakes = 0
+        pooled_requests = 0
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # The pool was evicted after we listed the keys
+                continue
+            handshakes += pool.num_connections
+            pooled_requests += pool.num_requests
+        with self._lock:
+            requests_sent = self._requests
+        return {"requests": requests_sent,
+                "handshakes": handshakes,
+                "reused_connections": max(pooled_requests - handshakes, 0)}
+
+    def close(self):
+        """Close all connections in the pool."""
+        self.session.close()
+
+
 class SpeciesAPI:
     """Handles requests to Artportalens Artfakta - Species information API."""
 
-    def __init__(self, api_key: str):
-        """Initialization. The client is responsible for managing secrets."""
+    def __init__(self, api_key: str, session: ApiSession = None):
+        """Initialization. The client is responsible for managing secrets. If no `session` is
+           given the object gets its own pooled session."""
         self.key = api_key
+        self.session = session or ApiSession()
         self.url = API_ROOT_URL + "/information/v1/speciesdataservice/v1/"
         self.search_url = self.url + "speciesdata"
         self.headers = auth_headers(self.key)
@@ -142,7 +262,7 @@ class SpeciesAPI:
     def taxa_by_name(self, name, exact_match=True):
         """Returns list of all taxa that match the name."""
         url = self.search_url + f"/search?searchString={name}"
-        r = requests.get(url, headers=self.headers)
+        r = self.session.get(url, headers=self.headers)
         log_request(logger,
                     r,
                     message="HTTP request to Species API",
@@ -160,7 +280,7 @@ class SpeciesAPI:
     def taxon_by_id(self, id):
         """Returns the taxon with the given id."""
         url = self.search_url + f"?taxa={id}"
-        r = requests.get(url, headers=self.headers)
+        r = self.session.get(url, headers=self.headers)
         log_request(logger,
                     r,
                     message="HTTP request to Species API",
@@ -301,9 +421,11 @@ class ObservationsAPI:
     # See the Observation object in the API for alternative attributes to sort by.
     DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS = 'event.startDate'
 
-    def __init__(self, api_key: str):
-        """Initialization. The client is responsible for managing secrets."""
+    def __init__(self, api_key: str, session: ApiSession = None):
+        """Initialization. The client is responsible for managing secrets. If no `session` is
+           given the object gets its own pooled session."""
         self.key = api_key
+        self.session = session or ApiSession()
         self.url = API_ROOT_URL + "/species-observation-system/v1/"
         self.search_url = self.url + "Observations/Search"
         self.observation_url = self.url + "Observations/{id}"
@@ -320,7 +442,7 @@ class ObservationsAPI:
            See: https://api-portal.artdatabanken.se/api-details#
            api=sos-api-v1&operation=ApiInfo_GetApiInfo"""
         url = self.url + "api/ApiInfo"
-        r = requests.get(url, headers=self.headers)
+        r = self.session.get(url, headers=self.headers)
         log_request(logger,
                     r,
                     message="HTTP request to Observations API",
@@ -332,7 +454,7 @@ class ObservationsAPI:
            See: https://api-portal.artdatabanken.se/api-details#
            api=sos-api-v1&operation=DataProviders_GetDataProviders"""
         url = self.url + "/DataProviders"
-        r = requests.get(url, headers=self.headers)
+        r = self.session.get(url, headers=self.headers)
         log_request(logger,
                     r,
                     message="HTTP request to Observations API",
@@ -348,7 +470,7 @@ class ObservationsAPI:
                   "sortOrder": "Desc"}
         headers = self.headers | {"Content-Type": "application/json"}
         search_filter = EXAMPLE_SEARCH_FILTER_STR
-        r = requests.post(url, params=params, headers=headers, data=search_filter)
+        r = self.session.post(url, params=params, headers=headers, data=search_filter)
         log_request(logger,
                     r,
                     message="HTTP request to Observations API",
@@ -362,7 +484,7 @@ class ObservationsAPI:
     @retry(
         retry=retry_if_exception(_is_429_http_error),
         stop=stop_after_attempt(5),
-        wait=wait_exponential(multiplier=1, min=1, max=31),
+        wait=wait_retry_after,
         before_sleep=before_sleep_log(logger, logging.WARNING),
         reraise=True
     )
@@ -393,7 +515,10 @@ class ObservationsAPI:
                   "translationCultureCode": translationCultureCode}
         headers = self.headers | {"Content-Type": "application/json"}
         try:
-            r = requests.post(url, params=params, headers=headers, data=searchFilter.json_string())
+            r = self.session.post(url,
+                                  params=params,
+                                  headers=headers,
+                                  data=searchFilter.json_string())
             logger.info("Call to artportalen.observations()",
                         extra={"attributes": {"searchFilter": searchFilter.filter,
                                               "skip": skip,
@@ -416,7 +541,8 @@ class ObservationsAPI:
 
             # If the response is ok, return the JSON in the response body
             if r.ok:
-                return r.json()
+                with timing.stage("decode"):
+                    return r.json()
 
             # If not ok, raise an exception that will not be retried by tenacity
             r.raise_for_status()
@@ -446,7 +572,7 @@ class ObservationsAPI:
                   "resolveGeneralizedObservations": "false"}
         headers = self.headers | {"Content-Type": "application/json"}
         try:
-            r = requests.get(url, params=params, headers=headers)
+            r = self.session.get(url, params=params, headers=headers)
             r.raise_for_status()
             logger.info("Call to artportalen.observation_by_id()",
                         extra={"attributes": {"id": id,
@@ -468,6 +594,34 @@ class ObservationsAPI:
             return r.json()
 
 
+def interval_search_filter(geopolygon: list[tuple[float]],
+                           taxon_ids: list[int],
+                           from_date: datetime = None,
+                           to_date: datetime = None,
+                           m_from_date: datetime = None,
+                           m_to_date: datetime = None) -> SearchFilter:
+    """The search filter used for bulk downloads of observations of the taxa with `taxon_ids`
+       within `geopolygon` in the time interval [`from_date`, `to_date`], and optionally only
+       those modified in the interval [`m_from_date`, `m_to_date`]."""
+    sfilter = SearchFilter()
+    sfilter.set_taxon(ids=taxon_ids)
+    sfilter.set_geographics_geometries(geometries=[{"type": "polygon",
+                                                    "coordinates": [geopolygon]}])
+    sfilter.set_verification_status()
+    sfilter.set_output(fieldSet="Extended")
+    f_date = from_date.isoformat() if from_date else None
+    t_date = to_date.isoformat() if to_date else None
+    sfilter.set_date(f_date,
+                     t_date,
+                     dateFilterType="OverlappingStartDateAndEndDate",
+                     timeRanges=[])
+    mf_date = m_from_date.isoformat() if m_from_date else None
+    mt_date = m_to_date.isoformat() if m_to_date else None
+    sfilter.set_modified_date(mf_date, mt_date)
+    sfilter.set_dataProvider()
+    return sfilter
+
+
 @dataclass(frozen=True)
 class DateTimeInterval:
     """Represents a date and time interval."""
@@ -479,7 +633,13 @@ class ObservationsByTimeIntervalRequester:
     """A utility class for downloading all, or a larger number, of observations from Artportalens
        Observations Service API. The API has a limit of offset == 50.000 when getting paged results
        from a search, so we need to split searches into multiple searches where each has less than
-       `max_no`(50.000) records."""
+       `max_no`(50.000) records.
+       With `max_workers` > 1 the pages of all the time intervals are fetched concurrently by
+       that many worker threads, but the observations are still yielded in the same order as
+       when they are fetched one page at a time.
+       If `no_of_observations` is given, the requester trusts it and neither probes the API for
+       the number of observations nor splits the time interval. That is how requesters are built
+       from a planner.DownloadPlan, see `from_plan()`."""
 
     def __init__(self,
                  oapi: ObservationsAPI,
@@ -490,7 +650,9 @@ class ObservationsByTimeIntervalRequester:
                  m_from_date: datetime = None,
                  m_to_date: datetime = None,
                  take: int = 1000,
-                 max_no: int = 50000):
+                 max_no: int = 50000,
+                 max_workers: int = 1,
+                 no_of_observations: int = None):
         """Initialization."""
         self.oapi = oapi
         self.geopolygon = geopolygon
@@ -501,39 +663,15 @@ class ObservationsByTimeIntervalRequester:
         self.taxon_ids = taxon_ids
         self.take = take
         self.max_no = max_no
+        self.max_workers = max_workers
         self.subrequesters = None
-        self.no_of_observations = None
+        self.no_of_observations = no_of_observations
+        if self.no_of_observations is not None:
+            return
 
         # Get the number of observations in the time interval defined bytes
         # [from_date, to_date]
-        sfilter = SearchFilter()
-        sfilter.set_taxon(ids=self.taxon_ids)
-        sfilter.set_geographics_geometries(geometries=[{"type": "polygon",
-                                                        "coordinates": [self.geopolygon]}])
-        sfilter.set_verification_status()
-        sfilter.set_output(fieldSet="Extended")
-        if self.from_date:
-            f_date = self.from_date.isoformat()
-        else:
-            f_date = None
-        if self.to_date:
-            t_date = self.to_date.isoformat()
-        else:
-            t_date = None
-        sfilter.set_date(f_date,
-                         t_date,
-                         dateFilterType="OverlappingStartDateAndEndDate",
-                         timeRanges=[])
-        if self.m_from_date:
-            mfdate = self.m_from_date.isoformat()
-        else:
-            mfdate = None
-        if self.m_from_date:
-            mtdate = self.m_to_date.isoformat()
-        else:
-            mtdate = None
-        sfilter.set_modified_date(mfdate, mtdate)
-        sfilter.set_dataProvider()
+        sfilter = self._search_filter()
         try:
             observations = self.oapi.observations(sfilter,
                                                   skip=0,
@@ -550,11 +688,10 @@ class ObservationsByTimeIntervalRequester:
         self.no_of_observations = observations["totalCount"]
         if self.no_of_observations > self.max_no:
             # Split the time interval in two and create two ObservationsByTimeIntervalRequester
-            pass
             interval = DateTimeInterval(from_date=self.from_date, to_date=self.to_date)
             intervals = self.__interval_split__(interval)
-            import pprint
-            pprint.pprint(intervals)
+            logger.debug("Split time interval in ObservationsByTimeIntervalRequester",
+                         extra={"attributes": {"intervals": [repr(i) for i in intervals]}})
             subrequester_1 = ObservationsByTimeIntervalRequester(oapi=self.oapi,
                                                                  geopolygon=self.geopolygon,
                                                                  from_date=intervals[0].from_date,
@@ -563,7 +700,8 @@ class ObservationsByTimeIntervalRequester:
                                                                  m_from_date=self.m_from_date,
                                                                  m_to_date=self.m_to_date,
                                                                  take=self.take,
-                                                                 max_no=self.max_no)
+                                                                 max_no=self.max_no,
+                                                                 max_workers=self.max_workers)
             subrequester_2 = ObservationsByTimeIntervalRequester(oapi=self.oapi,
                                                                  geopolygon=self.geopolygon,
                                                                  from_date=intervals[1].from_date,
@@ -572,9 +710,46 @@ class ObservationsByTimeIntervalRequester:
                                                                  m_from_date=self.m_from_date,
                                                                  m_to_date=self.m_to_date,
                                                                  take=self.take,
-                                                                 max_no=self.max_no)
+                                                                 max_no=self.max_no,
+                                                                 max_workers=self.max_workers)
             self.subrequesters = [subrequester_1, subrequester_2]
 
+    @classmethod
+    def from_plan(cls,
+                  oapi: ObservationsAPI,
+                  geopolygon: list[tuple[float]],
+                  plan,
+                  take: int = 1000,
+                  max_workers: int = 1) -> ObservationsByTimeIntervalRequester:
+        """A requester for all the intervals in the planner.DownloadPlan `plan`, without any
+           further count requests to the API."""
+        root = cls(oapi, geopolygon, plan.from_date, plan.to_date, plan.taxon_ids,
+                   m_from_date=plan.m_from_date,
+                   m_to_date=plan.m_to_date,
+                   take=take,
+                   max_no=plan.max_no,
+                   max_workers=max_workers,
+                   no_of_observations=plan.no_of_observations())
+        root.subrequesters = [cls(oapi, geopolygon, i.from_date, i.to_date, plan.taxon_ids,
+                                  m_from_date=plan.m_from_date,
+                                  m_to_date=plan.m_to_date,
+                                  take=take,
+                                  max_no=plan.max_no,
+                                  max_workers=max_workers,
+                                  no_of_observations=i.no_of_observations)
+                              for i in plan.intervals]
+        return root
+
+    def _search_filter(self) -> SearchFilter:
+        """The search filter for the time interval and modified date interval of this
+           requester."""
+        return interval_search_filter(self.geopolygon,
+                                      self.taxon_ids,
+                                      self.from_date,
+                                      self.to_date,
+                                      self.m_from_date,
+                                      self.m_to_date)
+
     def _short_polygon_repr_(self, polygon):
         if not polygon:
             return "[]"
@@ -647,58 +822,58 @@ class ObservationsByTimeIntervalRequester:
         interval_2 = DateTimeInterval(from_date=mid_zero_plus_1ms, to_date=interval.to_date)
         return (interval_1, interval_2)
 
-    def observations(self):
-        """Generator for getting observations from API."""
+    def leaves(self):
+        """Generator for the requesters, in time order, that are not split into subrequesters and
+           that actually get observations from the API."""
         if self.subrequesters:
-            for o in self.subrequesters[0].observations():
-                yield o
-            for o in self.subrequesters[1].observations():
-                yield o
+            for sr in self.subrequesters:
+                yield from sr.leaves()
         else:
-            skip = 0
-            done = False
-            while not done:
-                sfilter = SearchFilter()
-                sfilter.set_taxon(ids=self.taxon_ids)
-                sfilter.set_geographics_geometries(geometries=[{"type": "polygon",
-                                                                "coordinates": [self.geopolygon]}])
-                sfilter.set_verification_status()
-                sfilter.set_output(fieldSet="Extended")
-                if self.from_date:
-                    fdate = self.from_date.isoformat()
-                else:
-                    fdate = None
-                if self.from_date:
-                    tdate = self.to_date.isoformat()
-                else:
-                    tdate = None
-                sfilter.set_date(fdate,
-                                 tdate,
-                                 dateFilterType="OverlappingStartDateAndEndDate",
-                                 timeRanges=[])
-                if self.m_from_date:
-                    mfdate = self.m_from_date.isoformat()
-                else:
-                    mfdate = None
-                if self.m_from_date:
-                    mtdate = self.m_to_date.isoformat()
-                else:
-                    mtdate = None
-                sfilter.set_modified_date(mfdate, mtdate)
-                sfilter.set_dataProvider()
-                try:
-                    _observations = self.oapi.observations(sfilter,
-                                                           skip,
-                                                           take=self.take,
-                                                           sort_descending=False)
-                except Exception as e:
-                    # Log unexpected errors and propagate (so caller can handle).
-                    logger.error(("Exception caught in "
-                                  "artportalen.ObservationsByTimeIntervalRequester.observations()"),
-                                 exc_info=True,
-                                 extra={"exception": e})
-                    raise
-                for o in _observations['records']:
-                    yield o
-                done = skip + self.take >= self.no_of_observations
-                skip += self.take
+            yield self
+
+    def pages(self) -> list[tuple[ObservationsByTimeIntervalRequester, int]]:
+        """List of (requester, skip) tuples, in order, for all pages of observations to get from
+           the API. The offsets are known since the number of observations in every time interval
+           is known."""
+        return [(leaf, skip)
+                for leaf in self.leaves()
+                for skip in range(0, leaf.no_of_observations, leaf.take)]
+
+    def _page(self, skip: int) -> list[dict]:
+        """The observation records in the page starting at `skip` + 1."""
+        sfilter = self._search_filter()
+        try:
+            _observations = self.oapi.observations(sfilter,
+                                                   skip,
+                                                   take=self.take,
+                                                   sort_descending=False)
+        except Exception as e:
+            # Log unexpected errors and propagate (so caller can handle).
+            logger.error(("Exception caught in "
+                          "artportalen.ObservationsByTimeIntervalRequester.observations()"),
+                         exc_info=True,
+                         extra={"exception": e})
+            raise
+        return _observations['records']
+
+    def observations(self):
+        """Generator for getting observations from API."""
+        pages = self.pages()
+        if self.max_workers <= 1:
+            for leaf, skip in pages:
+                yield from leaf._page(skip)
+            return
+
+        # Keep a bounded window of pages in flight and yield them in order as they complete.
+        executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                      thread_name_prefix="artportalen-pages")
+        in_flight = deque()
+        try:
+            for leaf, skip in pages:
+                in_flight.append(executor.submit(leaf._page, skip))
+                if len(in_flight) >= 2 * self.max_workers:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,389 @@
+"""
+Planning of bulk downloads from Artportalens Observations Service API. The API does not allow
+paging beyond an offset of 50.000 records, so a bulk download must be split into time intervals
+that each have fewer observations than that. Observations are concentrated to recent years, so
+instead of splitting the time interval in halves, the DownloadPlanner probes the number of
+observations per year (and per month and per day where needed) concurrently, and packs the
+results into time intervals with close to, but not more than, `max_no` observations.
+Plans can be saved to and loaded from JSON-files. A loaded plan is refreshed by re-probing only
+the time intervals with observations that have been modified since they were probed.
+"""
+
+from __future__ import annotations
+import hashlib
+import json
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+
+from .client import ObservationsAPI, interval_search_filter
+
+logger = logging.getLogger(__name__)
+
+ONE_MICROSECOND = timedelta(microseconds=1)
+PLAN_FILE_FORMAT_VERSION = 1
+
+
+class CountCallBudgetExceeded(RuntimeError):
+    """Raised when a plan can't be made within the allowed number of count requests."""
+
+
+def geopolygon_digest(geopolygon: list[tuple[float]]) -> str:
+    """A short digest of `geopolygon`, used to check that a saved plan is for the same area."""
+    return hashlib.sha1(json.dumps(geopolygon).encode("utf-8")).hexdigest()[:16]
+
+
+def _iso(d: datetime | None) -> str | None:
+    return d.isoformat() if d else None
+
+
+def _from_iso(s: str | None) -> datetime | None:
+    return datetime.fromisoformat(s) if s else None
+
+
+@dataclass(frozen=True)
+class PlannedInterval:
+    """A time interval in a download plan, its number of observations and when that number was
+       probed."""
+    from_date: datetime
+    to_date: datetime
+    no_of_observations: int
+    probed_at: datetime | None = None
+
+    def overlaps(self, from_date: datetime, to_date: datetime) -> bool:
+        """True if this interval overlaps [`from_date`, `to_date`]."""
+        return self.from_date <= to_date and from_date <= self.to_date
+
+    def to_dict(self) -> dict:
+        return {"from_date": _iso(self.from_date),
+                "to_date": _iso(self.to_date),
+                "no_of_observations": self.no_of_observations,
+                "probed_at": _iso(self.probed_at)}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> PlannedInterval:
+        return cls(from_date=_from_iso(d["from_date"]),
+                   to_date=_from_iso(d["to_date"]),
+                   no_of_observations=d["no_of_observations"],
+                   probed_at=_from_iso(d.get("probed_at")))
+
+
+@dataclass
+class DownloadPlan:
+    """A plan for downloading all observations between `from_date` and `to_date`. The
+       `intervals` are in time order and each has at most `max_no` observations. `count_calls`
+       is the number of count requests made to the API to make the plan."""
+    from_date: datetime
+    to_date: datetime
+    taxon_ids: list[int]
+    m_from_date: datetime | None = None
+    m_to_date: datetime | None = None
+    max_no: int = 50000
+    intervals: list[PlannedInterval] = field(default_factory=list)
+    count_calls: int = 0
+    geopolygon_digest: str | None = None
+
+    def no_of_observations(self) -> int:
+        """The total number of observations in the plan. Observations that overlap two intervals
+           are counted in both."""
+        return sum(i.no_of_observations for i in self.intervals)
+
+    def to_dict(self) -> dict:
+        return {"version": PLAN_FILE_FORMAT_VERSION,
+                "from_date": _iso(self.from_date),
+                "to_date": _iso(self.to_date),
+                "taxon_ids": self.taxon_ids,
+                "m_from_date": _iso(self.m_from_date),
+                "m_to_date": _iso(self.m_to_date),
+                "max_no": self.max_no,
+                "geopolygon_digest": self.geopolygon_digest,
+                "count_calls": self.count_calls,
+                "intervals": [i.to_dict() for i in self.intervals]}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> DownloadPlan:
+        if d.get("version") != PLAN_FILE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported download plan format version: {d.get('version')!r}")
+        return cls(from_date=_from_iso(d["from_date"]),
+                   to_date=_from_iso(d["to_date"]),
+                   taxon_ids=d["taxon_ids"],
+                   m_from_date=_from_iso(d["m_from_date"]),
+                   m_to_date=_from_iso(d["m_to_date"]),
+                   max_no=d["max_no"],
+                   intervals=[PlannedInterval.from_dict(i) for i in d["intervals"]],
+                   count_calls=d["count_calls"],
+                   geopolygon_digest=d["geopolygon_digest"])
+
+    def save(self, file_path: Path):
+        """Save the plan as a JSON-file. The file is replaced atomically."""
+        file_path = Path(file_path)
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.to_dict(), indent=2), encoding="utf-8")
+        tmp_path.replace(file_path)
+
+    @classmethod
+    def load(cls, file_path: Path) -> DownloadPlan:
+        """Load a plan from a JSON-file saved with `save()`."""
+        return cls.from_dict(json.loads(Path(file_path).read_text(encoding="utf-8")))
+
+
+def _year_chunks(from_date: datetime, to_date: datetime) -> list[tuple[datetime, datetime]]:
+    """Split [`from_date`, `to_date`] into calendar years."""
+    chunks = []
+    start = from_date
+    while start <= to_date:
+        next_start = datetime(start.year + 1, 1, 1, tzinfo=start.tzinfo)
+        chunks.append((start, min(next_start - ONE_MICROSECOND, to_date)))
+        start = next_start
+    return chunks
+
+
+def _month_chunks(from_date: datetime, to_date: datetime) -> list[tuple[datetime, datetime]]:
+    """Split [`from_date`, `to_date`] into calendar months."""
+    chunks = []
+    start = from_date
+    while start <= to_date:
+        if start.month == 12:
+            next_start = datetime(start.year + 1, 1, 1, tzinfo=start.tzinfo)
+        else:
+            next_start = datetime(start.year, start.month + 1, 1, tzinfo=start.tzinfo)
+        chunks.append((start, min(next_start - ONE_MICROSECOND, to_date)))
+        start = next_start
+    return chunks
+
+
+def _day_chunks(from_date: datetime, to_date: datetime) -> list[tuple[datetime, datetime]]:
+    """Split [`from_date`, `to_date`] into calendar days."""
+    chunks = []
+    start = from_date
+    while start <= to_date:
+        next_start = datetime(start.year, start.month, start.day,
+                              tzinfo=start.tzinfo) + timedelta(days=1)
+        chunks.append((start, min(next_start - ONE_MICROSECOND, to_date)))
+        start = next_start
+    return chunks
+
+
+# The granularities, from coarse to fine, a time interval is split into when probing
+_SPLITTERS = [_year_chunks, _month_chunks, _day_chunks]
+
+
+class DownloadPlanner:
+    """Makes DownloadPlan:s by probing the number of observations in the time intervals with
+       `max_workers` concurrent count requests (`take=1`) to the API. At most `max_count_calls`
+       count requests are made for a plan."""
+
+    # The number of modified observations to look at when refreshing a plan
+    REFRESH_PAGE_SIZE = 1000
+
+    def __init__(self,
+                 oapi: ObservationsAPI,
+                 geopolygon: list[tuple[float]],
+                 taxon_ids: list[int],
+                 m_from_date: datetime = None,
+                 m_to_date: datetime = None,
+                 max_no: int = 50000,
+                 max_workers: int = 4,
+                 max_count_calls: int = 1000):
+        """Initialization."""
+        self.oapi = oapi
+        self.geopolygon = geopolygon
+        self.taxon_ids = taxon_ids
+        self.m_from_date = m_from_date
+        self.m_to_date = m_to_date
+        self.max_no = max_no
+        self.max_workers = max_workers
+        self.max_count_calls = max_count_calls
+        self.count_calls = 0
+
+    def _search(self, from_date: datetime, to_date: datetime, take: int = 1,
+                m_from_date: datetime = None, m_to_date: datetime = None) -> dict:
+        """Search result with `take` observations in the time interval [`from_date`, `to_date`].
+           The modified date interval defaults to the one of the planner."""
+        sfilter = interval_search_filter(self.geopolygon,
+                                         self.taxon_ids,
+                                         from_date,
+                                         to_date,
+                                         m_from_date or self.m_from_date,
+                                         m_to_date or self.m_to_date)
+        try:
+            return self.oapi.observations(sfilter,
+                                          skip=0,
+                                          take=take,
+                                          sort_descending=True)
+        except Exception as e:
+            # Log unexpected errors and propagate (so caller can handle).
+            logger.error("Exception caught in artportalen.DownloadPlanner._search()",
+                         exc_info=True,
+                         extra={"exception": e})
+            raise
+
+    def count(self, from_date: datetime, to_date: datetime) -> int:
+        """The number of observations in the time interval [`from_date`, `to_date`]."""
+        return self._search(from_date, to_date)["totalCount"]
+
+    def probe(self, chunks: list[tuple[datetime, datetime]]) -> list[PlannedInterval]:
+        """Count the observations in all `chunks` concurrently."""
+        if self.count_calls + len(chunks) > self.max_count_calls:
+            raise CountCallBudgetExceeded(
+                f"Probing {len(chunks)} more time intervals would exceed the budget of "
+                f"{self.max_count_calls} count requests ({self.count_calls} already made)")
+        self.count_calls += len(chunks)
+        probed_at = datetime.now()
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix="artportalen-probes") as executor:
+            counts = list(executor.map(lambda c: self.count(*c), chunks))
+        return [PlannedInterval(f, t, n, probed_at) for (f, t), n in zip(chunks, counts)]
+
+    def _refined(self, intervals: list[PlannedInterval], level: int) -> list[PlannedInterval]:
+        """`intervals` where every interval with more than `max_no` observations is replaced by
+           probed intervals of the granularity at `level` (recursively finer if needed)."""
+        too_large = [i for i in intervals if i.no_of_observations > self.max_no]
+        if not too_large:
+            return intervals
+        if level >= len(_SPLITTERS):
+            for i in too_large:
+                logger.warning("Time interval can't be split to fewer observations than max_no",
+                               extra={"attributes": {"from_date": i.from_date.isoformat(),
+                                                     "to_date": i.to_date.isoformat(),
+                                                     "no_of_observations": i.no_of_observations,
+                                                     "max_no": self.max_no}})
+            return intervals
+
+        # Probe all too large intervals in one concurrent batch
+        splitter = _SPLITTERS[level]
+        chunks_per_interval = [splitter(i.from_date, i.to_date) for i in too_large]
+        probed = self.probe([c for chunks in chunks_per_interval for c in chunks])
+        refined = {}
+        start = 0
+        for i, chunks in zip(too_large, chunks_per_interval):
+            refined[i] = probed[start:start + len(chunks)]
+            start += len(chunks)
+
+        result = []
+        for i in intervals:
+            result.extend(refined.get(i, [i]))
+        return self._refined(result, level + 1)
+
+    def _packed(self, intervals: list[PlannedInterval]) -> list[PlannedInterval]:
+        """Consecutive `intervals` merged into as few intervals as possible with at most `max_no`
+           observations each."""
+        result = []
+        current = None
+        for i in intervals:
+            if current is None:
+                current = i
+            elif current.no_of_observations + i.no_of_observations <= self.max_no:
+                probed_at = min((p for p in (current.probed_at, i.probed_at) if p), default=None)
+                current = PlannedInterval(current.from_date,
+                                          i.to_date,
+                                          current.no_of_observations + i.no_of_observations,
+                                          probed_at)
+            else:
+                result.append(current)
+                current = i
+        if current is not None:
+            result.append(current)
+        return result
+
+    def _planned_intervals(self, from_date: datetime, to_date: datetime) -> list[PlannedInterval]:
+        """Probed and packed intervals for all observations between `from_date` and `to_date`."""
+        years = self.probe(_year_chunks(from_date, to_date))
+        return self._packed(self._refined(years, level=1))
+
+    def _new_plan(self, from_date: datetime, to_date: datetime,
+                  intervals: list[PlannedInterval]) -> DownloadPlan:
+        plan = DownloadPlan(from_date=from_date,
+                            to_date=to_date,
+                            taxon_ids=self.taxon_ids,
+                            m_from_date=self.m_from_date,
+                            m_to_date=self.m_to_date,
+                            max_no=self.max_no,
+                            intervals=intervals,
+                            count_calls=self.count_calls,
+                            geopolygon_digest=geopolygon_digest(self.geopolygon))
+        logger.info("Made download plan",
+                    extra={"attributes": {"from_date": from_date.isoformat(),
+                                          "to_date": to_date.isoformat(),
+                                          "intervals": len(plan.intervals),
+                                          "no_of_observations": plan.no_of_observations(),
+                                          "count_calls": plan.count_calls}})
+        return plan
+
+    def plan(self, from_date: datetime, to_date: datetime) -> DownloadPlan:
+        """A DownloadPlan for all observations between `from_date` and `to_date`."""
+        self.count_calls = 0
+        return self._new_plan(from_date, to_date, self._planned_intervals(from_date, to_date))
+
+    def is_compatible(self, plan: DownloadPlan) -> bool:
+        """True if `plan` was made for the same area, taxa, modified date interval and `max_no`
+           as this planner uses."""
+        return (plan.geopolygon_digest == geopolygon_digest(self.geopolygon)
+                and plan.taxon_ids == self.taxon_ids
+                and plan.m_from_date == self.m_from_date
+                and plan.m_to_date == self.m_to_date
+                and plan.max_no == self.max_no)
+
+    def _modified_intervals(self, plan: DownloadPlan, since: datetime) -> list[PlannedInterval]:
+        """The intervals in `plan` with observations modified since `since`. One request finds
+           the modified observations. If there are more of them than fit in one page, all
+           intervals are considered modified."""
+        if self.m_to_date and self.m_to_date < since:
+            # The plan only covers observations modified before `since`
+            return []
+        self.count_calls += 1
+        result = self._search(plan.from_date, plan.to_date,
+                              take=self.REFRESH_PAGE_SIZE,
+                              m_from_date=max(since, self.m_from_date or since))
+        if result["totalCount"] == 0:
+            return []
+        if result["totalCount"] > len(result["records"]):
+            return list(plan.intervals)
+        modified = []
+        for i in plan.intervals:
+            for o in result["records"]:
+                start = datetime.fromisoformat(o["event"]["startDate"]).replace(tzinfo=None)
+                end = datetime.fromisoformat(o["event"]["endDate"]).replace(tzinfo=None)
+                if i.overlaps(start, end):
+                    modified.append(i)
+                    break
+        return modified
+
+    def refreshed(self, plan: DownloadPlan, from_date: datetime, to_date: datetime) -> DownloadPlan:
+        """A DownloadPlan for all observations between `from_date` and `to_date`, reusing the
+           intervals in the saved `plan`. Only intervals with observations modified since they
+           were probed are probed again, and time after the end of `plan` is planned anew. If the
+           plan can't be reused, a new plan is made."""
+        if not self.is_compatible(plan) or from_date != plan.from_date or to_date < plan.to_date:
+            logger.info("Saved download plan can't be reused, making a new plan")
+            return self.plan(from_date, to_date)
+
+        self.count_calls = 0
+        checked_at = datetime.now()
+        since = min((i.probed_at for i in plan.intervals if i.probed_at), default=None)
+        if since is None:
+            stale = list(plan.intervals)
+        else:
+            stale = self._modified_intervals(plan, since)
+
+        # Re-probe the stale intervals and split the ones that have grown too large
+        reprobed = {}
+        if stale:
+            probed = self.probe([(i.from_date, i.to_date) for i in stale])
+            for old, new in zip(stale, probed):
+                if new.no_of_observations > self.max_no:
+                    reprobed[old] = self._planned_intervals(old.from_date, old.to_date)
+                else:
+                    reprobed[old] = [new]
+        # Intervals that were not re-probed are known to be unchanged up until now
+        intervals = []
+        for i in plan.intervals:
+            intervals.extend(reprobed.get(i, [replace(i, probed_at=checked_at)]))
+
+        # Plan the time after the end of the saved plan
+        if to_date > plan.to_date:
+            intervals.extend(self._planned_intervals(plan.to_date + ONE_MICROSECOND, to_date))
+
+        return self._new_plan(from_date, to_date, intervals)
@@ -7,11 +7,21 @@ the local Artportalen cache database.
 # Basic Python modules
 from enum import StrEnum
 from typing import List
-from requests.exceptions import HTTPError
+from datetime import date
+import asyncio
+import json
+import threading
+from requests.exceptions import RequestException
+import httpx
 
 # Application modules
 from app.mapping import MappingService
-from . import client, cache
+from app.utils import timing
+from app.utils.ratelimit import RateLimiter
+from app.utils.singleflight import SingleFlight, AsyncSingleFlight
+from app.utils.ttlcache import TTLCache
+from app.observations.rarity import RarityIndex
+from . import client, async_client, cache
 
 
 class Vocabulary(StrEnum):
@@ -34,41 +44,128 @@ class ArtportalenService():
         self.area_name = area_name
         self.logger = logger
 
-        # Set up the API client
+        # Set up the API clients. They share one pooled HTTP session, since both API:s are
+        # served from the same host, and one rate limiter.
+        s = self.settings
+        self.rate_limiter = RateLimiter(rate=s.ARTPORTALEN_RATE_LIMIT_PER_SECOND,
+                                        burst=s.ARTPORTALEN_RATE_LIMIT_BURST,
+                                        default_pause=s.ARTPORTALEN_RATE_LIMIT_DEFAULT_PAUSE)
+        config = client.HTTPSessionConfig(pool_maxsize=s.ARTPORTALEN_HTTP_POOL_SIZE,
+                                          keep_alive=s.ARTPORTALEN_HTTP_KEEP_ALIVE,
+                                          connect_timeout=s.ARTPORTALEN_HTTP_CONNECT_TIMEOUT,
+                                          read_timeout=s.ARTPORTALEN_HTTP_READ_TIMEOUT)
+        self.http_session = client.ApiSession(config, rate_limiter=self.rate_limiter)
         v = self.settings.ARTPORTALEN_SPECIES_API_KEY.get_secret_value()
-        self.sapi = client.SpeciesAPI(v)
+        self.sapi = client.SpeciesAPI(v, session=self.http_session)
         v = self.settings.ARTPORTALEN_OBSERVATIONS_API_KEY.get_secret_value()
-        self.oapi = client.ObservationsAPI(v)
+        self.oapi = client.ObservationsAPI(v, session=self.http_session)
+
+        # Set up the async API clients, used by the async route handlers in the web app
+        self.async_http_session = async_client.AsyncApiSession(config,
+                                                               rate_limiter=self.rate_limiter)
+        v = self.settings.ARTPORTALEN_SPECIES_API_KEY.get_secret_value()
+        self.async_sapi = async_client.AsyncSpeciesAPI(v, session=self.async_http_session)
+        v = self.settings.ARTPORTALEN_OBSERVATIONS_API_KEY.get_secret_value()
+        self.async_oapi = async_client.AsyncObservationsAPI(v, session=self.async_http_session)
+
+        # Concurrent identical observation searches share one call to the API
+        self.singleflight = SingleFlight()
+        self.async_singleflight = AsyncSingleFlight()
+
+        # In-memory cache of observation search results, with stale-while-revalidate
+        self.observations_cache = TTLCache(maxsize=s.OBSERVATIONS_CACHE_SIZE)
+        self._refresh_lock = threading.Lock()
+        self._refreshing = set()
+        self._refresh_tasks = set()
+        self._prefetch_tasks = set()
+        self._prefetches_started = 0
+        self._prefetches_skipped = 0
 
         # Set up the cache database
         self.cachedb = cache.DuckDBCache(self.settings,
                                          self.area_name,
                                          cache_open_mode)
+        self.rarity_index = self._rarity_index()
+        # Incremented when the rarity index changes, so that what is rendered with it can be
+        # told apart
+        self.rarity_index_version = 0
+
+    def http_stats(self) -> dict[str, int]:
+        """Request, handshake and connection reuse counters for the HTTP sessions (sync and async
+           added together) used for calls to the Artportalen API:s."""
+        stats = self.http_session.stats()
+        for k, v in self.async_http_session.stats().items():
+            stats[k] += v
+        return stats
+
+    def rate_limiter_stats(self) -> dict:
+        """Time spent waiting for the rate limiter versus time spent in requests to the
+           Artportalen API:s."""
+        return self.rate_limiter.stats()
+
+    def coalescing_stats(self) -> dict[str, int]:
+        """The number of observation searches made to the API and the number of searches that
+           shared the result of an identical search in flight (sync and async added together)."""
+        stats = self.singleflight.stats()
+        for k, v in self.async_singleflight.stats().items():
+            stats[k] += v
+        return stats
+
+    def close(self):
+        """Close the connections to the Artportalen API:s and the cache database."""
+        self.http_session.close()
+        self.cachedb.close()
+
+    async def aclose(self):
+        """Close the connections to the Artportalen API:s, including the async ones."""
+        self.close()
+        await self.async_http_session.aclose()
+
+    def refresh_cache(self) -> list[tuple[date, date]] | None:
+        """Switch to the latest published generation of the cache database, if there is a new
+           one. Cached search results for dates with changed observations are dropped, and the
+           rarity index is rebuilt, with a new `rarity_index_version` if it changed. Returns the
+           date ranges, as (from date, to date) tuples, with changed observations, which is all
+           dates if the changes aren't known, or None if there was no new generation."""
+        synced_at = self.cachedb.synced_at()
+        if not self.cachedb.refresh():
+            return None
+        changed = self.cachedb.changed_date_ranges(synced_at)
+        if changed is None:
+            changed = [(date.min, date.max)]
+
+        def overlaps_changes(key) -> bool:
+            from_date = date.fromisoformat(key[1])
+            to_date = date.fromisoformat(key[2])
+            return any(f <= to_date and from_date <= t for f, t in changed)
+
+        n = self.observations_cache.invalidate_if(overlaps_changes)
+        self.logger.info("Invalidated observations cache entries of changed dates",
+                         extra={"attributes": {"entries": n, "date_ranges": len(changed)}})
+        rarity_index = self._rarity_index()
+        if rarity_index != self.rarity_index:
+            self.rarity_index = rarity_index
+            self.rarity_index_version += 1
+        return changed
+
+    def _rarity_index(self) -> RarityIndex:
+        """The rarity index built from the species summary in the cache database."""
+        if not self.settings.features.cache_database_enabled:
+            return RarityIndex()
+        return RarityIndex.from_species_summary(self.cachedb.species_data())
 
     def cache_timestamp(self):
         """The timestamp of the cache database in "YYYY-MM-DD HH:MM:SS" format."""
         return self.cachedb.timestamp()
 
-    def get_observations(self,
-                         mapping: MappingService,
-                         area_name: str,
-                         from_date: str,
-                         to_date: str,
-                         taxon_name: str = None,
-                         observer_name: str = None):
-        """Get observations from Artportalen API."""
-        # Get the taxa ids that match the given `taxon_name`.
-        taxon_ids = [self.settings.DEFAULT_TAXON_SEARCH_ID]
-        if taxon_name:
-            taxa = self.sapi.taxa_by_name(taxon_name,
-                                          exact_match=True)
-            if not taxa:
-                self.settings.debug((f"No taxa matching {taxon_name}"),
-                                    ("found in Artportalen Species API"))
-            else:
-                taxon_ids = [t["taxonId"] for t in taxa]
-
-        # Set up the search filter for the Artportalen Observations API
+    def _observations_search_filter(self,
+                                    mapping: MappingService,
+                                    area_name: str,
+                                    from_date: str,
+                                    to_date: str,
+                                    taxon_ids: list[int]) -> client.SearchFilter:
+        """The search filter for the Artportalen Observations API for observations of the taxa
+           with `taxon_ids` in the area `area_name` between `from_date` and `to_date`."""
         sfilter = client.SearchFilter()
         sfilter.set_taxon(ids=taxon_ids)
 
@@ -84,18 +181,325 @@ class ArtportalenService():
                          timeRanges=[])
         sfilter.set_modified_date()
         sfilter.set_dataProvider()
+        return sfilter
+
+    @staticmethod
+    def _search_key(sfilter: client.SearchFilter, **params) -> str:
+        """Key that identifies an observation search with the search filter `sfilter` and the
+           paging and sorting `params`, independent of the order of attributes."""
+        return json.dumps({"filter": sfilter.filter, "params": params}, sort_keys=True)
+
+    def _taxon_ids(self, taxon_name: str, taxa) -> list[int]:
+        """The taxa ids in `taxa` as returned by the Species API for `taxon_name`, or the default
+           taxon search id if there are no `taxa`."""
+        if not taxa:
+            if taxon_name:
+                self.logger.debug(f"No taxa matching {taxon_name} found in Artportalen Species API")
+            return [self.settings.DEFAULT_TAXON_SEARCH_ID]
+        return [t["taxonId"] for t in taxa]
+
+    @staticmethod
+    def _recorded_by(observations, observer_name: str = None):
+        """The `observations` from the API with `observer_name` among their observers, or all of
+           them if there is no `observer_name`. The API can't search on observers, so they are
+           filtered here, by the same names as in the cache database. The result is a new object,
+           since `observations` may be shared by coalesced searches."""
+        if not observer_name or not observations:
+            return observations
+        name = cache.normalized_person_name(observer_name)
+        records = [o for o in observations.get("records", [])
+                   if name in (cache.normalized_person_name(p) for p in
+                               o.get("occurrence", {}).get("recordedBy", "").split(","))]
+        return observations | {"totalCount": len(records), "records": records}
+
+    def _observations_from_api(self,
+                               mapping: MappingService,
+                               area_name: str,
+                               from_date: str,
+                               to_date: str,
+                               taxon_name: str = None,
+                               observer_name: str = None):
+        """Get observations from Artportalen API."""
+        params = {"skip": 0, "take": 1000, "sort_descending": True}
         try:
-            observations = self.oapi.observations(sfilter,
-                                                  skip=0,
-                                                  take=1000,
-                                                  sort_descending=True)
-        except HTTPError as e:
-            self.logger.warning("HTTPError in artportalen.observations()",
+            # Get the taxa ids that match the given `taxon_name`.
+            taxa = None
+            if taxon_name:
+                taxa = self.sapi.taxa_by_name(taxon_name,
+                                              exact_match=True)
+            taxon_ids = self._taxon_ids(taxon_name, taxa)
+
+            sfilter = self._observations_search_filter(mapping, area_name, from_date, to_date,
+                                                       taxon_ids)
+            observations = self.singleflight.do(
+                self._search_key(sfilter, **params),
+                lambda: self.oapi.observations(sfilter, **params))
+        except RequestException as e:
+            # HTTP errors as well as timeouts and connection errors
+            self.logger.warning("RequestException in artportalen.observations()",
+                                extra={"exception": e})
+            return None
+
+        return self._recorded_by(observations, observer_name)
+
+    async def _observations_from_api_async(self,
+                                           mapping: MappingService,
+                                           area_name: str,
+                                           from_date: str,
+                                           to_date: str,
+                                           taxon_name: str = None,
+                                           observer_name: str = None):
+        """Get observations from Artportalen API without blocking the event loop. Same as
+           `_observations_from_api()`."""
+        params = {"skip": 0, "take": 1000, "sort_descending": True}
+        try:
+            taxa = None
+            if taxon_name:
+                taxa = await self.async_sapi.taxa_by_name(taxon_name,
+                                                          exact_match=True)
+            taxon_ids = self._taxon_ids(taxon_name, taxa)
+
+            sfilter = self._observations_search_filter(mapping, area_name, from_date, to_date,
+                                                       taxon_ids)
+            observations = await self.async_singleflight.do(
+                self._search_key(sfilter, **params),
+                lambda: self.async_oapi.observations(sfilter, **params))
+        except httpx.HTTPError as e:
+            # Status errors as well as transport errors, such as timeouts
+            self.logger.warning("HTTPError in artportalen.async_client.observations()",
                                 extra={"exception": e})
             return None
 
+        return self._recorded_by(observations, observer_name)
+
+    def _cachedb_covers(self,
+                        from_date: str,
+                        to_date: str,
+                        taxon_name: str = None,
+                        observer_name: str = None) -> bool:
+        """True if the observations can be read from the cache database instead of the API."""
+        return (self.settings.features.cache_database_enabled
+                and taxon_name is None
+                and self.cachedb.covers(from_date, to_date))
+
+    def _fetch_observations(self,
+                            mapping: MappingService,
+                            area_name: str,
+                            from_date: str,
+                            to_date: str,
+                            taxon_name: str = None,
+                            observer_name: str = None):
+        """Get observations from the cache database if it covers the dates, otherwise from
+           Artportalen API."""
+        if self._cachedb_covers(from_date, to_date, taxon_name, observer_name):
+            with timing.stage("cachedb"):
+                if observer_name:
+                    return self.cachedb.observations_by_observer(observer_name,
+                                                                 from_date,
+                                                                 to_date)
+                return self.cachedb.observations(from_date, to_date)
+        return self._observations_from_api(mapping, area_name, from_date, to_date,
+                                           taxon_name, observer_name)
+
+    async def _fetch_observations_async(self,
+                                        mapping: MappingService,
+                                        area_name: str,
+                                        from_date: str,
+                                        to_date: str,
+                                        taxon_name: str = None,
+                                        observer_name: str = None):
+        """Same as `_fetch_observations()`, without blocking the event loop."""
+        if self._cachedb_covers(from_date, to_date, taxon_name, observer_name):
+            with timing.stage("cachedb"):
+                if observer_name:
+                    return await asyncio.to_thread(self.cachedb.observations_by_observer,
+                                                   observer_name, from_date, to_date)
+                return await asyncio.to_thread(self.cachedb.observations, from_date, to_date)
+        return await self._observations_from_api_async(mapping, area_name, from_date, to_date,
+                                                       taxon_name, observer_name)
+
+    def observations_ttl(self, to_date: str) -> float:
+        """The number of seconds observations up until `to_date` (in "YYYY-MM-DD" format) are
+           kept fresh in the observations cache. The older the date, the less likely it is that
+           its observations change."""
+        try:
+            age = (date.today() - date.fromisoformat(to_date[:10])).days
+        except ValueError:
+            age = 0
+        if age <= 0:
+            return self.settings.OBSERVATIONS_CACHE_TTL_TODAY
+        elif age <= 7:
+            return self.settings.OBSERVATIONS_CACHE_TTL_LAST_WEEK
+        else:
+            return self.settings.OBSERVATIONS_CACHE_TTL_OLDER
+
+    def _cache_observations(self, key, to_date: str, observations):
+        # Failed searches are not cached
+        if observations:
+            self.observations_cache.set(key, observations, self.observations_ttl(to_date))
+
+    def _start_refresh(self, key) -> bool:
+        """True if a refresh of `key` may start, i.e. if there isn't one already running."""
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def _end_refresh(self, key):
+        with self._refresh_lock:
+            self._refreshing.discard(key)
+
+    def _refresh(self, key, args):
+        try:
+            self._cache_observations(key, args[3], self._fetch_observations(*args))
+        except Exception as e:
+            self.logger.warning("Failed to refresh cached observations",
+                                exc_info=True,
+                                extra={"exception": e})
+        finally:
+            self._end_refresh(key)
+
+    async def _refresh_async(self, key, args):
+        try:
+            observations = await self._fetch_observations_async(*args)
+            self._cache_observations(key, args[3], observations)
+        except Exception as e:
+            self.logger.warning("Failed to refresh cached observations",
+                                exc_info=True,
+                                extra={"exception": e})
+        finally:
+            self._end_refresh(key)
+
+    def get_observations(self,
+                         mapping: MappingService,
+                         area_name: str,
+                         from_date: str,
+                         to_date: str,
+                         taxon_name: str = None,
+                         observer_name: str = None):
+        """Get observations from the observations cache, the cache database or Artportalen API.
+           Stale cached observations are returned while they are refreshed in a background
+           thread."""
+        key = (area_name, from_date, to_date, taxon_name, observer_name)
+        args = (mapping, area_name, from_date, to_date, taxon_name, observer_name)
+        with timing.stage("cache"):
+            cached = self.observations_cache.get(key)
+        if cached is not None:
+            if cached.stale and self._start_refresh(key):
+                threading.Thread(target=self._refresh,
+                                 args=(key, args),
+                                 name="artportalen-refresh",
+                                 daemon=True).start()
+            return cached.value
+
+        observations = self._fetch_observations(*args)
+        self._cache_observations(key, to_date, observations)
+        return observations
+
+    async def get_observations_async(self,
+                                     mapping: MappingService,
+                                     area_name: str,
+                                     from_date: str,
+                                     to_date: str,
+                                     taxon_name: str = None,
+                                     observer_name: str = None):
+        """Get observations from the observations cache, the cache database or Artportalen API
+           without blocking the event loop. Stale cached observations are returned while they are
+           refreshed in a background task."""
+        key = (area_name, from_date, to_date, taxon_name, observer_name)
+        args = (mapping, area_name, from_date, to_date, taxon_name, observer_name)
+        with timing.stage("cache"):
+            cached = self.observations_cache.get(key)
+        if cached is not None:
+            if cached.stale and self._start_refresh(key):
+                task = asyncio.create_task(self._refresh_async(key, args))
+                # Keep a reference to the task so it isn't garbage collected while running
+                self._refresh_tasks.add(task)
+                task.add_done_callback(self._refresh_tasks.discard)
+            return cached.value
+
+        observations = await self._fetch_observations_async(*args)
+        self._cache_observations(key, to_date, observations)
         return observations
 
+    async def _prefetch_async(self, key, args):
+        try:
+            observations = await self._fetch_observations_async(*args)
+            self._cache_observations(key, args[3], observations)
+        except Exception as e:
+            self.logger.info("Failed to prefetch observations",
+                             exc_info=True,
+                             extra={"exception": e})
+        finally:
+            self._end_refresh(key)
+
+    def prefetch_observations(self,
+                              mapping: MappingService,
+                              area_name: str,
+                              observation_dates: list[str]) -> int:
+        """Fetch the observations of each of the `observation_dates` (in "YYYY-MM-DD" format)
+           into the observations cache in background tasks, unless they are already cached and
+           fresh or being fetched. It is speculative, so a date is skipped if there already are
+           OBSERVATIONS_PREFETCH_MAX_IN_FLIGHT prefetches running, or if it needs the Artportalen
+           API:s and the rate limiter has less than OBSERVATIONS_PREFETCH_MIN_TOKENS requests to
+           spare. Must be called from the event loop. Returns the number of prefetches started."""
+        started = 0
+        for observation_date in observation_dates:
+            key = (area_name, observation_date, observation_date, None, None)
+            args = (mapping, area_name, observation_date, observation_date, None, None)
+            if self.observations_cache.has_fresh(key):
+                continue
+            if (len(self._prefetch_tasks) >= self.settings.OBSERVATIONS_PREFETCH_MAX_IN_FLIGHT
+                    or (not self._cachedb_covers(observation_date, observation_date, None, None)
+                        and self.rate_limiter.available()
+                        < self.settings.OBSERVATIONS_PREFETCH_MIN_TOKENS)):
+                self._prefetches_skipped += 1
+                continue
+            if not self._start_refresh(key):
+                continue
+            task = asyncio.create_task(self._prefetch_async(key, args))
+            # Keep a reference to the task so it isn't garbage collected while running
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+            self._prefetches_started += 1
+            started += 1
+        return started
+
+    def prefetch_stats(self) -> dict[str, int]:
+        """The number of prefetches started, skipped for lack of room, and now in flight."""
+        return {"started": self._prefetches_started,
+                "skipped": self._prefetches_skipped,
+                "in_flight": len(self._prefetch_tasks)}
+
+    def observations_cache_stats(self) -> dict[str, int]:
+        """Hit, stale hit, miss and eviction counters of the observations cache."""
+        return self.observations_cache.stats()
+
+    def cache_pool_stats(self) -> dict:
+        """Checkout and wait counters of the cursor pool of the cache database."""
+        return self.cachedb.pool.stats()
+
+    def observer_observations(self,
+                              observer_name: str,
+                              from_date: str = None,
+                              to_date: str = None,
+                              skip: int = 0,
+                              take: int = None):
+        """Get a page of the observations of `observer_name`, newest first, from the cache
+           database. The Artportalen API can't search on observers, so this returns None if the
+           cache database is not enabled or has never been synchronized."""
+        if (not self.settings.features.cache_database_enabled
+                or self.cachedb.synced_at() is None):
+            return None
+        take = take or self.settings.DEFAULT_NUMBER_OF_OBSERVATIONS
+        with timing.stage("cachedb"):
+            return self.cachedb.observations_by_observer(observer_name,
+                                                         from_date,
+                                                         to_date,
+                                                         skip=skip,
+                                                         take=take)
+
     def species_data(self,
                      from_date: str = None,
                      to_date: str = None,
@@ -104,6 +508,18 @@ class ArtportalenService():
         """Get species data from Artportalen cache database."""
         return self.cachedb.species_data()
 
+    def species_summary_page(self,
+                             sort_key: cache.SpeciesSortKey = cache.SpeciesSortKey.OBSERVATIONS,
+                             descending: bool = True,
+                             name_prefix: str = None,
+                             skip: int = 0,
+                             take: int = None):
+        """Get a page of the species summary from Artportalen cache database."""
+        take = take or self.settings.SPECIES_PAGE_SIZE
+        with timing.stage("cachedb"):
+            return self.cachedb.species_summary_page(sort_key, descending, name_prefix, skip,
+                                                     take)
+
     def vocabulary_term(self,
                         code: int,
                         vocabulary: Vocabulary = Vocabulary.SEX,
@@ -0,0 +1,135 @@
+"""
+Incremental synchronization of the cache database with Artportalens Observations Service API.
+Instead of downloading all observations of an area again, a delta sync only asks for the
+observations that have been modified since the high-water mark of the previous sync, upserts them
+into the cache database and stores a new high-water mark. The first sync of a database has no
+high-water mark, and downloads all observations.
+"""
+
+from __future__ import annotations
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from .cache import DuckDBCache
+from .client import ObservationsAPI, ObservationsByTimeIntervalRequester
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FROM_DATE = datetime(1900, 1, 1)
+
+# Each sync asks for observations modified a little before the high-water mark too, in case the
+# clocks of this host and the API differ. Upserting an observation twice is harmless.
+WATERMARK_OVERLAP = timedelta(minutes=10)
+
+# The cache database is clustered after syncs of at least this many observations
+CLUSTER_THRESHOLD = 10000
+
+
+@dataclass(frozen=True)
+class SyncResult:
+    """The outcome of a delta sync. `ingest_seconds` is the part of `seconds` spent inserting
+       observations into the cache database, the rest is mostly spent waiting for the API."""
+    m_from_date: datetime | None
+    m_to_date: datetime
+    no_of_observations: int
+    seconds: float
+    ingest_seconds: float
+
+    @property
+    def records_per_second(self) -> float:
+        """The throughput of the whole sync."""
+        return round(self.no_of_observations / self.seconds, 1) if self.seconds else 0.0
+
+    @property
+    def ingest_records_per_second(self) -> float:
+        """The throughput of inserting observations into the cache database."""
+        if not self.ingest_seconds:
+            return 0.0
+        return round(self.no_of_observations / self.ingest_seconds, 1)
+
+
+class DeltaSync:
+    """Keeps the cache database `cachedb` current with the observations of the taxa with
+       `taxon_ids` within `geopolygon`."""
+
+    def __init__(self,
+                 oapi: ObservationsAPI,
+                 cachedb: DuckDBCache,
+                 geopolygon: list[tuple[float]],
+                 taxon_ids: list[int],
+                 from_date: datetime = DEFAULT_FROM_DATE,
+                 max_workers: int = 1,
+                 batch_size: int = 5000):
+        """Initialization. Observations from `from_date` and onwards are synchronized, in
+           batches of `batch_size` observations, with pages fetched by `max_workers` threads."""
+        self.oapi = oapi
+        self.cachedb = cachedb
+        self.geopolygon = geopolygon
+        self.taxon_ids = taxon_ids
+        self.from_date = from_date
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+
+    def _batches(self, observations):
+        """The `observations` in lists of `batch_size` observations."""
+        batch = []
+        for o in observations:
+            batch.append(o)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self, now: datetime = None) -> SyncResult:
+        """Upsert all observations modified since the high-water mark into the cache database,
+           update the species summary, then store `now` (default the current time) as the new
+           high-water mark. If the sync
+           fails the high-water mark is left as it is, so the next sync starts over from it."""
+        tic = time.perf_counter()
+        now = now or datetime.now(timezone.utc)
+        watermark = self.cachedb.modified_watermark()
+        self.cachedb.begin_changes()
+        m_from_date = watermark - WATERMARK_OVERLAP if watermark else None
+        logger.info("Delta sync of cache database",
+                    extra={"attributes": {"path": str(self.cachedb.path),
+                                          "m_from_date": str(m_from_date),
+                                          "m_to_date": str(now)}})
+
+        requester = ObservationsByTimeIntervalRequester(self.oapi,
+                                                        self.geopolygon,
+                                                        self.from_date,
+                                                        now.replace(tzinfo=None),
+                                                        self.taxon_ids,
+                                                        m_from_date=m_from_date,
+                                                        m_to_date=now,
+                                                        max_workers=self.max_workers)
+        # The pages of the next batch are fetched by the requester's workers while a batch is
+        # inserted
+        n = 0
+        ingest_seconds = 0.0
+        for batch in self._batches(requester.observations()):
+            t = time.perf_counter()
+            n += self.cachedb.upsert_observations(batch)
+            ingest_seconds += time.perf_counter() - t
+        self.cachedb.update_species_summary()
+        if n >= CLUSTER_THRESHOLD:
+            self.cachedb.cluster()
+
+        self.cachedb.set_modified_watermark(now)
+        self.cachedb.set_synced_at(now)
+        result = SyncResult(m_from_date=m_from_date,
+                            m_to_date=now,
+                            no_of_observations=n,
+                            seconds=round(time.perf_counter() - tic, 3),
+                            ingest_seconds=round(ingest_seconds, 3))
+        logger.info("Delta sync of cache database done",
+                    extra={"attributes": {"path": str(self.cachedb.path),
+                                          "no_of_observations": n,
+                                          "seconds": result.seconds,
+                                          "records_per_second": result.records_per_second,
+                                          "ingest_records_per_second":
+                                              result.ingest_records_per_second}})
+        return result
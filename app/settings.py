@@ -48,6 +48,8 @@ class FeatureToggles(BaseModel):
     cache_database_enabled: bool = False
     # Turn off species pages until we have a cache database.
     species_page_enabled: bool = False
+    # Turn off the metrics endpoint unless it is asked for, since it shows internals of the app.
+    metrics_endpoint_enabled: bool = False
 
     def enabled_flags(self) -> dict[str, bool]:
         return {
@@ -87,10 +89,41 @@ class Settings(BaseSettings):
     DATE_FORMAT: str = "Date: %a, %d %b %Y %H:%M:%S"
     DEFAULT_TAXON_SEARCH_ID: int = 4000104
     DEFAULT_NUMBER_OF_OBSERVATIONS: int = 50
+    SPECIES_PAGE_SIZE: int = 50
+
+    # In-memory cache of observations. The time-to-live (in seconds) of cached observations
+    # depends on how many days ago the observation date is.
+    OBSERVATIONS_CACHE_SIZE: int = 512
+    OBSERVATIONS_CACHE_TTL_TODAY: int = 60
+    OBSERVATIONS_CACHE_TTL_LAST_WEEK: int = 15 * 60
+    OBSERVATIONS_CACHE_TTL_OLDER: int = 6 * 60 * 60
+    # After serving the observations of a date, the observations of the adjacent dates are
+    # fetched into the cache in the background, with at most this many fetches in flight (0 turns
+    # prefetching off). Prefetches that need the Artportalen API:s are only made while the rate
+    # limiter has at least OBSERVATIONS_PREFETCH_MIN_TOKENS requests to spare.
+    OBSERVATIONS_PREFETCH_MAX_IN_FLIGHT: int = 2
+    OBSERVATIONS_PREFETCH_MIN_TOKENS: float = 4.0
+    # In-memory cache of the rendered observations sections of past dates, which are kept as long
+    # as the observations they show (see above)
+    FRAGMENT_CACHE_SIZE: int = 256
+    # Stream the observations page when its observations section isn't in the fragment cache, so
+    # the top of the page reaches the browser while the observations are fetched and rendered
+    OBSERVATIONS_PAGE_STREAMING: bool = True
+
+    # Compression of responses. HTML (and other responses of at least GZIP_MINIMUM_SIZE bytes) is
+    # gzipped on the fly, static assets are gzipped once when the app starts.
+    GZIP_MINIMUM_SIZE: int = 1000
+    GZIP_COMPRESS_LEVEL: int = 6
 
     # Database cache directories
     CACHE_DATABASE_DIR: Path = Path("./cache")
     CACHE_SCHEMA_DIR: Path = Path("./cache/sql/")
+    # Observations for the last days before the cache database was synchronized may still change
+    # in Artportalen, so they are fetched from the API
+    CACHE_DATABASE_FRESHNESS_DAYS: int = 7
+    # Maximum number of concurrent searches in the cache database. Searches beyond it wait for
+    # a cursor.
+    CACHE_DATABASE_POOL_SIZE: int = 8
 
     ABOUT_SECTIONS: Mapping[str, str] = {
         "about-app": "about-app.md",
@@ -100,6 +133,18 @@ class Settings(BaseSettings):
     }
     ABOUT_DEFAULT_SLUG: str = "about-app"
 
+    # HTTP connection pool and timeouts (in seconds) for requests to the Artportalen API:s
+    ARTPORTALEN_HTTP_POOL_SIZE: int = 16
+    ARTPORTALEN_HTTP_KEEP_ALIVE: bool = True
+    ARTPORTALEN_HTTP_CONNECT_TIMEOUT: float = 3.05
+    ARTPORTALEN_HTTP_READ_TIMEOUT: float = 30.0
+
+    # Client-side rate limit (token bucket) shared by all calls to the Artportalen API:s, and
+    # the pause (in seconds) for all calls when a 429 response lacks a Retry-After header
+    ARTPORTALEN_RATE_LIMIT_PER_SECOND: float = 5.0
+    ARTPORTALEN_RATE_LIMIT_BURST: int = 10
+    ARTPORTALEN_RATE_LIMIT_DEFAULT_PAUSE: float = 5.0
+
     # Secrets
     ARTPORTALEN_OBSERVATIONS_API_KEY: SecretStr | None = None
     ARTPORTALEN_SPECIES_API_KEY: SecretStr | None = None
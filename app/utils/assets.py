@@ -0,0 +1,86 @@
+"""
+Module for serving static assets with content-hashed ("fingerprinted") URLs. The assets are
+scanned once, when the app starts: every file gets a URL with a hash of its content in the file
+name, which can be cached by browsers forever, and the files that compress well get a gzipped
+variant kept in memory. The plain URLs of the assets are still served, for URLs that can't be
+changed, such as the ones in web app manifests.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path, PurePosixPath
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Files that are already compressed aren't gzipped again
+COMPRESSED_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".woff", ".woff2",
+                       ".gz", ".br", ".zip"}
+
+
+def fingerprinted_name(name: str, content: bytes) -> str:
+    """The file `name` with a hash of its `content` before its suffix, for example
+       "tailwind.css" -> "tailwind.1a2b3c4d5e6f.css"."""
+    path = PurePosixPath(name)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}"))
+
+
+class FingerprintedStaticFiles(StaticFiles):
+    """Static files served both from their plain paths and from fingerprinted paths. Responses
+       for fingerprinted paths are cacheable forever, and gzipped if the client accepts it and
+       the file compresses well."""
+
+    def __init__(self, *, directory: Path, url_prefix: str, compresslevel: int = 9):
+        """Initialization. `url_prefix` is the path the files are mounted at in the app."""
+        super().__init__(directory=directory)
+        self.url_prefix = url_prefix.rstrip("/")
+        self._fingerprinted: dict[str, str] = {}
+        self._originals: dict[str, str] = {}
+        self._gzipped: dict[str, bytes] = {}
+        for path in sorted(Path(directory).rglob("*")):
+            if not path.is_file():
+                continue
+            name = path.relative_to(directory).as_posix()
+            content = path.read_bytes()
+            fingerprinted = fingerprinted_name(name, content)
+            self._fingerprinted[name] = fingerprinted
+            self._originals[fingerprinted] = name
+            if path.suffix.lower() not in COMPRESSED_SUFFIXES:
+                compressed = gzip.compress(content, compresslevel=compresslevel, mtime=0)
+                if len(compressed) < 0.9 * len(content):
+                    self._gzipped[name] = compressed
+
+    def url(self, name: str) -> str:
+        """The URL of the asset `name` (relative to the directory of the assets). It is the
+           fingerprinted URL if the asset was there when the app started, otherwise the plain
+           URL."""
+        return f"{self.url_prefix}/{self._fingerprinted.get(name, name)}"
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        name = self._originals.get(Path(path).as_posix())
+        if name is None or scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        compressed = self._gzipped.get(name)
+        if compressed is not None and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            return Response(compressed,
+                            media_type=media_type,
+                            headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL,
+                                     "Content-Encoding": "gzip",
+                                     "Vary": "Accept-Encoding"})
+        response = await super().get_response(name, scope)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        if compressed is not None:
+            response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    def stats(self) -> dict[str, int]:
+        """The number of fingerprinted assets and the number with a gzipped variant."""
+        return {"assets": len(self._fingerprinted), "gzipped": len(self._gzipped)}
@@ -49,23 +49,27 @@ def log_request(logger,
        about the request and response. The extra data is extensive if the logging level is DEBUG,
        otherwise limited if the logging level is INFO. `request_headers_to_strip_away` lists
        request headers that should be stripped away and not logged, e.g. API keys."""
+    # Works with both `requests` and `httpx` response objects
+    reason = getattr(r, "reason", None) or getattr(r, "reason_phrase", "")
     extra = {"Request method": r.request.method,
-             "Request URL": r.url,
-             "Response status": f"{r.status_code} ({r.reason})"}
+             "Request URL": str(r.url),
+             "Response status": f"{r.status_code} ({reason})"}
     if logger.isEnabledFor(logging.DEBUG):
         # Remove sensitive HTTP headers
-        d = dict(r.request.headers)
-        for header in request_headers_to_strip_away:
-            del d[header]
+        strip = [h.lower() for h in request_headers_to_strip_away or []]
+        d = {k: v for k, v in r.request.headers.items() if k.lower() not in strip}
         # Make sure the request body is logged as JSON
-        if r.request.body:
-            body = json.loads(r.request.body)
+        request_body = getattr(r.request, "body", None)
+        if request_body is None:
+            request_body = getattr(r.request, "content", None)
+        if request_body:
+            body = json.loads(request_body)
         else:
             body = None
         debug_extra = {"Request headers": d,
-                       "Request URL": r.url,
+                       "Request URL": str(r.url),
                        "Request body": body,
-                       "Response status": f"{r.status_code} ({r.reason})",
+                       "Response status": f"{r.status_code} ({reason})",
                        "Response headers": dict(r.headers),
                        "Response body": r.json()}
         extra.update(debug_extra)
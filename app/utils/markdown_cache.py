@@ -0,0 +1,59 @@
+"""
+Module with an in-memory cache of Markdown files rendered as HTML. A file is rendered again only
+when its modification time or size has changed, so serving a page with Markdown content costs a
+stat() of the file instead of parsing it.
+"""
+
+import threading
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from app.utils.changelog_renderer import mistune_markdown_instance
+
+
+class _Rendered(NamedTuple):
+    mtime_ns: int
+    size: int
+    html: str
+
+
+class MarkdownCache:
+    """A thread-safe cache of rendered Markdown files, keyed by path and modification time."""
+
+    def __init__(self, *, disabled: bool = True):
+        """Initialization. `disabled` is passed on to the Markdown renderer, see
+           changelog_renderer.mistune_markdown_instance()."""
+        self.disabled = disabled
+        self._lock = threading.Lock()
+        self._rendered: dict[Path, _Rendered] = {}
+        self._renders = 0
+
+    def html(self, path: Path) -> str:
+        """The Markdown file at `path` rendered as HTML. Raises FileNotFoundError if there is no
+           such file."""
+        path = Path(path)
+        st = path.stat()
+        rendered = self._rendered.get(path)
+        if rendered and rendered.mtime_ns == st.st_mtime_ns and rendered.size == st.st_size:
+            return rendered.html
+
+        markdown = mistune_markdown_instance(disabled=self.disabled)
+        html = markdown(path.read_text(encoding="utf-8"))
+        with self._lock:
+            self._rendered[path] = _Rendered(st.st_mtime_ns, st.st_size, html)
+            self._renders += 1
+        return html
+
+    def preload(self, paths: Iterable[Path]):
+        """Render the Markdown files at `paths` ahead of their first use. Missing files are
+           skipped."""
+        for path in paths:
+            try:
+                self.html(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict[str, int]:
+        """The number of files rendered so far and the number of files in the cache."""
+        with self._lock:
+            return {"renders": self._renders, "size": len(self._rendered)}
@@ -0,0 +1,137 @@
+"""
+Module with a client-side rate limiter, for staying within the request quota of an API instead of
+finding it by getting HTTP status 429 (Too many requests) responses.
+"""
+
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from app.utils import timing
+
+
+def retry_after_seconds(headers) -> float | None:
+    """The number of seconds to wait according to the "Retry-After" header in `headers`, which may
+       be given in seconds or as a HTTP date. None if there is no valid header."""
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RateLimiter:
+    """A token bucket rate limiter that allows `rate` requests per second on average and bursts of
+       up to `burst` requests. One instance is meant to be shared by all threads and event loops
+       in a process that call the same API. Callers take a token with `acquire()` (or
+       `acquire_async()`) before every request, and call `pause()` when the API responds with
+       HTTP status 429, which makes all callers wait until the pause is over."""
+
+    def __init__(self, rate: float, burst: int = 1, default_pause: float = 5.0):
+        """Initialization. `default_pause` is the number of seconds to pause when a 429 response
+           has no "Retry-After" header."""
+        if rate <= 0:
+            raise ValueError("The rate of a RateLimiter must be positive.")
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.default_pause = default_pause
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+        # Metrics
+        self._acquired = 0
+        self._delayed = 0
+        self._wait_seconds = 0.0
+        self._requests = 0
+        self._request_seconds = 0.0
+        self._pauses = 0
+
+    def _refill(self, now: float):
+        """Add the tokens earned since the last refill, which is never before the end of the
+           latest pause. Must be called with the lock held."""
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _reserve(self) -> float:
+        """Take a token and return the number of seconds to wait before it may be used."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            # During a pause the bucket doesn't refill, so the callers waiting for it are spaced
+            # out at the rate after the pause instead of all being let through when it ends
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            delay += max(self._paused_until - now, 0.0)
+            self._acquired += 1
+            if delay > 0:
+                self._delayed += 1
+                self._wait_seconds += delay
+            return delay
+
+    def acquire(self):
+        """Wait until a request may be made."""
+        delay = self._reserve()
+        if delay > 0:
+            timing.record("throttle", delay)
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        """Wait, without blocking the event loop, until a request may be made."""
+        delay = self._reserve()
+        if delay > 0:
+            timing.record("throttle", delay)
+            await asyncio.sleep(delay)
+
+    def available(self) -> float:
+        """The number of requests that may be made right now without waiting, for callers that
+           only make optional requests when there is room for them. Doesn't take a token."""
+        with self._lock:
+            now = time.monotonic()
+            if self._paused_until > now:
+                return 0.0
+            return max(min(self.burst, self._tokens + (now - self._updated) * self.rate), 0.0)
+
+    def pause(self, seconds: float = None):
+        """Make all callers wait `seconds` (or `default_pause` seconds) from now before making
+           any more requests. The bucket is emptied and doesn't refill during the pause, so the
+           requests after it are made at the rate, not in a burst."""
+        if seconds is None:
+            seconds = self.default_pause
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = max(self._updated, self._paused_until)
+            self._pauses += 1
+
+    def record_request(self, seconds: float):
+        """Record that a request took `seconds` seconds."""
+        with self._lock:
+            self._requests += 1
+            self._request_seconds += seconds
+
+    def stats(self) -> dict:
+        """Metrics for the limiter. "wait_seconds" is the total time callers have waited for a
+           token (or for a pause to end) and "request_seconds" the total time spent in requests."""
+        with self._lock:
+            return {"acquired": self._acquired,
+                    "delayed": self._delayed,
+                    "wait_seconds": round(self._wait_seconds, 3),
+                    "requests": self._requests,
+                    "request_seconds": round(self._request_seconds, 3),
+                    "pauses": self._pauses}
@@ -0,0 +1,99 @@
+"""
+Module for request coalescing ("single-flight"). Concurrent calls with the same key share the
+result of one call of the underlying function instead of all calling it. The shared result is the
+same object for all callers, so it must not be mutated.
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _Call:
+    """An in-flight call in a SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Request coalescing for threads."""
+
+    def __init__(self):
+        """Initialization."""
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+        self._calls_made = 0
+        self._calls_shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Return the result of `fn()`, or of the in-flight call with the same `key` if there is
+           one. Exceptions from `fn()` are raised in all callers that share the call."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._calls_made += 1
+            else:
+                self._calls_shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict[str, int]:
+        """The number of calls made and the number of calls that shared another call's result."""
+        with self._lock:
+            return {"calls": self._calls_made, "shared": self._calls_shared}
+
+
+class AsyncSingleFlight:
+    """Request coalescing for asyncio tasks (in one event loop)."""
+
+    def __init__(self):
+        """Initialization."""
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self._calls_made = 0
+        self._calls_shared = 0
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark any exception as retrieved, in case all callers were cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the result of `await fn()`, or of the in-flight call with the same `key` if
+           there is one. The call runs as a task of its own, so it isn't cancelled if the caller
+           that started it is cancelled while other callers are waiting for it."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self._calls_made += 1
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self._calls_shared += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int]:
+        """The number of calls made and the number of calls that shared another call's result."""
+        return {"calls": self._calls_made, "shared": self._calls_shared}
@@ -0,0 +1,103 @@
+"""
+Module for timing the stages of serving a request, such as cache lookups, requests to upstream
+API:s and template rendering. The time spent in each stage is added up per request, so it can be
+reported in a Server-Timing header, and every timing is also recorded in a histogram per stage
+for the whole process, so it can be reported by a metrics endpoint.
+
+A request is timed from `begin_request()`. Code in any layer times a stage with
+`with stage("name"):` or `record("name", seconds)`, without having to pass anything along; the
+timings of the current request are kept in a context variable, which is inherited by the tasks
+that serve it and by calls run with asyncio.to_thread() or Starlette's run_in_threadpool().
+Plain threads and ThreadPoolExecutor.submit() don't copy the context, so stages timed in them,
+like stages timed outside of a request, only go to the histograms.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# The upper bounds, in milliseconds, of the histogram buckets. The last bucket has no bound.
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_stages: ContextVar[dict[str, float] | None] = ContextVar("request_stages", default=None)
+
+
+class Histogram:
+    """A thread-safe histogram of durations, with the buckets in BUCKETS_MS."""
+
+    def __init__(self):
+        """Initialization."""
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(BUCKETS_MS) + 1)
+        self._count = 0
+        self._sum_ms = 0.0
+
+    def observe(self, ms: float):
+        """Record a duration of `ms` milliseconds."""
+        with self._lock:
+            self._counts[bisect_left(BUCKETS_MS, ms)] += 1
+            self._count += 1
+            self._sum_ms += ms
+
+    def snapshot(self) -> dict:
+        """The number of durations recorded, their sum in milliseconds, and the cumulative number
+           of durations up to each bucket bound, as in Prometheus histograms."""
+        with self._lock:
+            buckets = {}
+            n = 0
+            for bound, count in zip([*BUCKETS_MS, "+Inf"], self._counts):
+                n += count
+                buckets[str(bound)] = n
+            return {"count": self._count, "sum_ms": round(self._sum_ms, 3), "buckets": buckets}
+
+
+_histograms_lock = threading.Lock()
+_histograms: dict[str, Histogram] = {}
+
+
+def _histogram(name: str) -> Histogram:
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    return histogram
+
+
+def begin_request():
+    """Start timing the stages of a new request in the current context."""
+    _request_stages.set({})
+
+
+def record(name: str, seconds: float):
+    """Record that the stage `name` took `seconds` seconds."""
+    ms = seconds * 1000
+    _histogram(name).observe(ms)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + ms
+
+
+@contextmanager
+def stage(name: str):
+    """Context manager that records the time spent in its block as the stage `name`."""
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - tic)
+
+
+def server_timing_metrics() -> list[str]:
+    """Server-Timing metrics with the time spent in each stage of the current request, in the
+       order the stages were first timed."""
+    stages = _request_stages.get() or {}
+    return [f"{name};dur={round(ms, 3)}" for name, ms in stages.items()]
+
+
+def histograms() -> dict[str, dict]:
+    """Snapshots of the histograms of all stages timed so far, by stage name."""
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    return {name: histogram.snapshot() for name, histogram in items}
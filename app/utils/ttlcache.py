@@ -0,0 +1,98 @@
+"""
+Module with a bounded in-memory LRU cache where every entry has its own time-to-live (TTL).
+Expired entries are kept until they are evicted, so they can be served stale while they are being
+refreshed.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, NamedTuple
+
+
+class _Entry(NamedTuple):
+    value: Any
+    expires_at: float
+
+
+class CachedValue(NamedTuple):
+    """A value found in a TTLCache, and whether it has expired."""
+    value: Any
+    stale: bool
+
+
+class TTLCache:
+    """A thread-safe LRU cache with at most `maxsize` entries and a TTL per entry."""
+
+    def __init__(self, maxsize: int):
+        """Initialization."""
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable) -> CachedValue | None:
+        """The value for `key`, fresh or stale, or None if there is no entry for `key`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            stale = entry.expires_at <= time.monotonic()
+            if stale:
+                self._stale_hits += 1
+            else:
+                self._hits += 1
+            return CachedValue(entry.value, stale)
+
+    def has_fresh(self, key: Hashable) -> bool:
+        """True if there is an entry for `key` that hasn't expired. Unlike `get()`, it doesn't
+           count as a hit or a miss or make the entry recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.expires_at > time.monotonic()
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        """Set the value for `key`, to expire in `ttl` seconds. Evicts the least recently used
+           entries if the cache is full."""
+        with self._lock:
+            self._entries[key] = _Entry(value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """Remove the entry for `key`, if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Remove the entries with keys for which `predicate` is true. Returns the number of
+           entries removed."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        """Hit, stale hit, miss and eviction counters, and the current number of entries."""
+        with self._lock:
+            return {"hits": self._hits,
+                    "stale_hits": self._stale_hits,
+                    "misses": self._misses,
+                    "evictions": self._evictions,
+                    "size": len(self._entries)}
@@ -0,0 +1,6 @@
+-- Index the observations on their start date, since the observations for a date are looked up
+-- on it. Observations should also be inserted ordered by event_plainStartDate, so that the
+-- min/max zone maps of the row groups let DuckDB skip the row groups outside a date range.
+
+CREATE INDEX IF NOT EXISTS observations_plain_start_date_idx
+  ON observations (event_plainStartDate);
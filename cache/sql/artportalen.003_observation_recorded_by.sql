@@ -0,0 +1,68 @@
+-- Recreate observation_recorded_by as a covering index for observer queries. Besides the person
+-- name it has the columns needed to present observations in the daily list (LIST_COLUMNS in
+-- cache.py), so the observations of an observer are read from this table only. Reading scattered
+-- rows from the observations table by their occurrence ids is slow in a columnar database.
+
+DROP TABLE IF EXISTS observation_recorded_by;
+
+CREATE TABLE observation_recorded_by (
+  person_name VARCHAR,
+  event_plainStartDate DATE,
+
+  -- LIST_COLUMNS
+  datasetName VARCHAR,
+  event_startDate TIMESTAMPTZ,
+  event_endDate TIMESTAMPTZ,
+  location_county_name VARCHAR,
+  location_decimalLatitude DOUBLE,
+  location_decimalLongitude DOUBLE,
+  location_locality VARCHAR,
+  location_municipality_name VARCHAR,
+  occurrence_activity_value VARCHAR,
+  occurrence_individualCount VARCHAR,
+  occurrence_lifeStage_value VARCHAR,
+  occurrence_occurrenceId VARCHAR,
+  occurrence_organismQuantity VARCHAR,
+  occurrence_recordedBy VARCHAR,
+  occurrence_sex_id INTEGER,
+  occurrence_url VARCHAR,
+  taxon_attributes_isRedlisted BOOLEAN,
+  taxon_attributes_redlistCategory VARCHAR,
+  taxon_scientificName VARCHAR,
+  taxon_vernacularName VARCHAR,
+
+  PRIMARY KEY (occurrence_occurrenceId, person_name)
+);
+
+-- Fill the table with one row per person in 'occurrence_recordedBy' of the observations already
+-- in the database. Names are trimmed and have their whitespace collapsed. The rows are inserted
+-- ordered by person_name, so that the min/max zone maps make lookups on a name cheap.
+
+INSERT INTO observation_recorded_by
+SELECT DISTINCT ON (occurrence_occurrenceId, person_name) *
+FROM (SELECT trim(regexp_replace(unnest(string_split(occurrence_recordedBy, ',')), '\s+', ' ', 'g'))
+               AS person_name,
+             event_plainStartDate,
+             datasetName,
+             event_startDate,
+             event_endDate,
+             location_county_name,
+             location_decimalLatitude,
+             location_decimalLongitude,
+             location_locality,
+             location_municipality_name,
+             occurrence_activity_value,
+             occurrence_individualCount,
+             occurrence_lifeStage_value,
+             occurrence_occurrenceId,
+             occurrence_organismQuantity,
+             occurrence_recordedBy,
+             occurrence_sex_id,
+             occurrence_url,
+             taxon_attributes_isRedlisted,
+             taxon_attributes_redlistCategory,
+             taxon_scientificName,
+             taxon_vernacularName
+      FROM observations)
+WHERE person_name <> ''
+ORDER BY person_name, event_startDate DESC;
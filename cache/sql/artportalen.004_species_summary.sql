@@ -0,0 +1,52 @@
+-- Create the table with the statistics of the observations of each species, shown on the species
+-- page. It is computed from the observations table by DuckDBCache.update_species_summary(), which
+-- recomputes the rows of the species with new or changed observations after each sync. Dates
+-- within the year are in "MM-DD" format.
+
+CREATE TABLE IF NOT EXISTS species_summary (
+  category VARCHAR,
+  taxon_id INTEGER,
+  taxon_vernacularName VARCHAR,
+  taxon_scientificName VARCHAR,
+  observations INTEGER,
+  years_with_observations INTEGER,
+  years_with_at_least_5_observations INTEGER,
+  years_with_observations_in_any_category INTEGER,
+  earliest_date DATE,
+  latest_date DATE,
+  earliest_date_any_year VARCHAR,
+  median_earliest_date_per_year VARCHAR,
+  avg_earliest_date_per_year VARCHAR,
+  latest_date_any_year VARCHAR,
+  median_latest_date_per_year VARCHAR,
+  avg_latest_date_per_year VARCHAR,
+  core_start_date VARCHAR,
+  core_end_date VARCHAR,
+  arrival_trend_days INTEGER,
+  observations_in_january INTEGER,
+  observations_in_february INTEGER,
+  observations_in_march INTEGER,
+  observations_in_april INTEGER,
+  observations_in_may INTEGER,
+  observations_in_june INTEGER,
+  observations_in_july INTEGER,
+  observations_in_august INTEGER,
+  observations_in_september INTEGER,
+  observations_in_october INTEGER,
+  observations_in_november INTEGER,
+  observations_in_december INTEGER,
+  rarity_classification VARCHAR,
+  rarity_classification_in_january VARCHAR,
+  rarity_classification_in_february VARCHAR,
+  rarity_classification_in_march VARCHAR,
+  rarity_classification_in_april VARCHAR,
+  rarity_classification_in_may VARCHAR,
+  rarity_classification_in_june VARCHAR,
+  rarity_classification_in_july VARCHAR,
+  rarity_classification_in_august VARCHAR,
+  rarity_classification_in_september VARCHAR,
+  rarity_classification_in_october VARCHAR,
+  rarity_classification_in_november VARCHAR,
+  rarity_classification_in_december VARCHAR,
+  PRIMARY KEY (category, taxon_id)
+);
@@ -0,0 +1,8 @@
+-- Create the table with the date ranges of the observations upserted by the last sync, and of the
+-- observations they replaced. Readers of a new generation of the database use it to invalidate
+-- what they have cached for those dates only. It is emptied at the start of each sync.
+
+CREATE TABLE IF NOT EXISTS changed_dates (
+  from_date DATE,
+  to_date DATE
+);